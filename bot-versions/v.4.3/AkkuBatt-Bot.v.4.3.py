@@ -19,6 +19,8 @@ DATABASE = os.environ.get('DATABASE_PATH', 'Reports.db')
 BUGS_DB = os.environ.get('BUGS_DB_PATH', 'BugReports.db')
 FEEDBACK_DB = os.environ.get('FEEDBACK_DB_PATH', 'Feedback.db')
 PHOTOS_DIR = os.environ.get('PHOTOS_DIR', 'photos')
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 5))  # секунд ожидания блокировки
+OUTBOX_SWEEP_INTERVAL = int(os.environ.get('OUTBOX_SWEEP_INTERVAL', 60))  # секунд между повторными проходами
 
 
 bot = telebot.TeleBot(API_TOKEN, threaded=True)
@@ -336,9 +338,30 @@ FeedbackAgreement = (
 # =====================================================================================================================
 # =====================================================================================================================
 
+# Соединения с базами живут в пределах потока и переиспользуются между вызовами.
+# WAL позволяет читать во время записи из соседнего потока, busy_timeout ждёт освобождения
+# блокировки вместо ошибки "database is locked", а подготовленные запросы кешируются в соединении.
+db_local = threading.local()
+
+def get_connection(path):
+    connections = getattr(db_local, 'connections', None)
+    if connections is None:
+        connections = db_local.connections = {}
+
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}")
+        connections[path] = conn
+    return conn
+
+# =====================================================================================================================
+
 # Локальная база данных для хранения отчетов
 def initialize_db():
-    create_base = sqlite3.connect(DATABASE)
+    create_base = get_connection(DATABASE)
     cursor = create_base.cursor()
 
     cursor.execute('''
@@ -357,11 +380,10 @@ def initialize_db():
     ''')
 
     create_base.commit()
-    create_base.close()
 
     # =====================================================================================================================
 
-    bugs_base = sqlite3.connect(BUGS_DB)
+    bugs_base = get_connection(BUGS_DB)
     bugs_cursor = bugs_base.cursor()
     bugs_cursor.execute('''
             CREATE TABLE IF NOT EXISTS bug_reports (
@@ -375,11 +397,10 @@ def initialize_db():
             )
         ''')
     bugs_base.commit()
-    bugs_base.close()
 
     # =====================================================================================================================
 
-    feedback_base = sqlite3.connect(FEEDBACK_DB)
+    feedback_base = get_connection(FEEDBACK_DB)
     feedback_cursor = feedback_base.cursor()
     feedback_cursor.execute('''
             CREATE TABLE IF NOT EXISTS feedback (
@@ -393,32 +414,143 @@ def initialize_db():
             )
         ''')
     feedback_base.commit()
-    feedback_base.close()
 
 initialize_db()
 
 # =====================================================================================================================
 
-# Парсинг базы на неотправленные отчёты
-def get_reports():
+# Единая очередь исходящих сообщений (outbox) для заявок, баг-репортов и предложений.
+# Каждая запись ссылается на строку в таблице своего типа, а отправкой занимается один поток.
+
+outbox_kinds = {}
+outbox_event = threading.Event()
+outbox_event.set()
+
+def initialize_outbox():
+    with get_connection(DATABASE) as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                ref_id INTEGER NOT NULL,
+                sent INTEGER DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (kind, ref_id)
+            )
+        ''')
+        # Порядок отправки — по id: CURRENT_TIMESTAMP хранит время с точностью до секунды
+        conn.execute("DROP INDEX IF EXISTS outbox_pending")
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_pending_by_id ON outbox (kind, sent, id)")
+
+initialize_outbox()
+
+# Регистрация типа сообщений: где лежат данные, куда и как их отправлять
+def register_outbox_kind(kind, database, table, chat_id, render, mark_sent):
+    outbox_kinds[kind] = {
+        'database': database,
+        'table': table,
+        'chat_id': chat_id,
+        'render': render,
+        'mark_sent': mark_sent
+    }
+    backfill_outbox(kind)
+
+# Ставит в очередь то, что осталось неотправленным до появления outbox или не попало в него при сохранении.
+# Таблицы не индексированы по sent, поэтому полный проход делается один раз при запуске
+def backfill_outbox(kind):
+    handler = outbox_kinds[kind]
     try:
-        with sqlite3.connect(DATABASE) as parsing_base:
-            cursor = parsing_base.cursor()
-            cursor.execute("SELECT * FROM reports WHERE sent = 0")
-            reports = cursor.fetchall()
+        with get_connection(handler['database']) as conn:
+            unsent = conn.execute(f"SELECT id FROM {handler['table']} WHERE sent = 0").fetchall()
+        if unsent:
+            with get_connection(DATABASE) as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO outbox (kind, ref_id) VALUES (?, ?)",
+                    [(kind, ref_id) for (ref_id,) in unsent]
+                )
+    except sqlite3.Error as e:
+        print(f"Ошибка при переносе неотправленных сообщений ({kind}) в outbox: {e}")
+
+# Постановка в очередь внутри транзакции вызывающего, conn должен быть подключением к DATABASE
+def enqueue_outbox(conn, kind, ref_id):
+    conn.execute("INSERT OR IGNORE INTO outbox (kind, ref_id) VALUES (?, ?)", (kind, ref_id))
 
+# Пробуждение потока отправки после фиксации транзакции
+def notify_outbox():
+    outbox_event.set()
+
+# Постановка в очередь строки из другого файла базы (баг-репорт, предложение), уже сохранённой своей транзакцией.
+# Если запись не удалась, строка остаётся с sent = 0 и попадёт в outbox при следующем запуске
+def enqueue_committed(kind, ref_id):
+    try:
+        with get_connection(DATABASE) as conn:
+            enqueue_outbox(conn, kind, ref_id)
     except sqlite3.Error as e:
-        print(f"Ошибка при получении отчетов: {e}")
-        reports = []
+        print(f"Ошибка при добавлении в outbox ({kind} #{ref_id}): {e}")
+    notify_outbox()
+
+def get_pending_outbox(kind):
+    with get_connection(DATABASE) as conn:
+        return conn.execute(
+            "SELECT id, ref_id FROM outbox WHERE kind = ? AND sent = 0 ORDER BY id",
+            (kind,)
+        ).fetchall()
+
+def mark_outbox_sent(outbox_id):
+    with get_connection(DATABASE) as conn:
+        conn.execute("UPDATE outbox SET sent = 1 WHERE id = ?", (outbox_id,))
+
+def load_outbox_row(handler, ref_id):
+    with get_connection(handler['database']) as conn:
+        return conn.execute(f"SELECT * FROM {handler['table']} WHERE id = ?", (ref_id,)).fetchone()
+
+# Отправка подготовленного сообщения: фото с подписью или обычный текст
+def deliver_outbox_message(chat_id, message):
+    text = message['text']
+    photo = message.get('photo')
+    options = {key: message[key] for key in ('reply_markup', 'parse_mode') if key in message}
+
+    if photo and os.path.isfile(photo):
+        try:
+            with open(photo, 'rb') as photo_file:
+                bot.send_photo(chat_id, photo_file, caption=text, **options)
+            return
+        except Exception as e:
+            print(f"Ошибка при отправке фото: {e}")
+            text += f"\n[Фото не удалось загрузить: {photo}]"
 
-    return reports
+    bot.send_message(chat_id, text, **options)
+
+def send_outbox():
+    while True:
+        # Ждём новое сообщение; по таймауту повторяем неудавшиеся отправки
+        outbox_event.wait(timeout=OUTBOX_SWEEP_INTERVAL)
+        outbox_event.clear()
+
+        for kind, handler in list(outbox_kinds.items()):
+            try:
+                pending = get_pending_outbox(kind)
+            except sqlite3.Error as e:
+                print(f"Ошибка при получении очереди outbox ({kind}): {e}")
+                continue
+
+            for outbox_id, ref_id in pending:
+                try:
+                    row = load_outbox_row(handler, ref_id)
+                    if row is not None:
+                        deliver_outbox_message(handler['chat_id'], handler['render'](row))
+                        handler['mark_sent'](ref_id)
+                    mark_outbox_sent(outbox_id)
+                except Exception as e:
+                    print(f"Ошибка при отправке сообщения из outbox ({kind} #{ref_id}): {e}")
+                    continue
 
 # =====================================================================================================================
 
 # Подготовка данных для отправки отчета
 def mark_as_sent(report_id):
     try:
-        with sqlite3.connect(DATABASE) as check_info:
+        with get_connection(DATABASE) as check_info:
             cursor = check_info.cursor()
             cursor.execute("UPDATE reports SET sent = 1 WHERE id = ?", (report_id,))
             check_info.commit()
@@ -428,84 +560,48 @@ def mark_as_sent(report_id):
 
 # =====================================================================================================================
 
-def send_reports():
-    while True:
-        reports = get_reports()
-        for report in reports:
-            try:
-                # Распаковываем только нужные нам поля (первые 10)
-                id, user_id, photo, rent_data, scooter_number, phone_number, card_number, description_of_the_problem, sent, returned = report[:10]
+# Формирование сообщения с заявкой на возврат
+def render_report(report):
+    # Распаковываем только нужные нам поля (первые 10)
+    id, user_id, photo, rent_data, scooter_number, phone_number, card_number, description_of_the_problem, sent, returned = report[:10]
 
-                try:
-                    with sqlite3.connect(DATABASE) as conn:
-                        cursor = conn.cursor()
-                        cursor.execute("SELECT COUNT(*) FROM reports WHERE phone_number = ?", (phone_number,))
-                        report_count = cursor.fetchone()[0]
-                except sqlite3.Error as e:
-                    print(f"Ошибка при получении количества отчетов: {e}")
-                    report_count = 1
-
-                message = (
-                    f"📝 Report: #{id}\n"
-                    f"───────────────────────────────\n"
-                    f"👤 User ID: {user_id}\n"
-                    f"📱 Номер телефона: {phone_number}\n"
-                    f"🔢 Количество отчетов от этого номера: {report_count}\n"
-                    f"⏱️ Дата и время начала аренды: {rent_data}\n"
-                    f"🛴 Номер самоката: {scooter_number}\n"
-                    f"💳 Номер карты: {card_number}\n"
-                    f"📋 Описание: {description_of_the_problem}\n"
-                    f"───────────────────────────────"
-                )
+    try:
+        with get_connection(DATABASE) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM reports WHERE phone_number = ?", (phone_number,))
+            report_count = cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Ошибка при получении количества отчетов: {e}")
+        report_count = 1
+
+    message = (
+        f"📝 Report: #{id}\n"
+        f"───────────────────────────────\n"
+        f"👤 User ID: {user_id}\n"
+        f"📱 Номер телефона: {phone_number}\n"
+        f"🔢 Количество отчетов от этого номера: {report_count}\n"
+        f"⏱️ Дата и время начала аренды: {rent_data}\n"
+        f"🛴 Номер самоката: {scooter_number}\n"
+        f"💳 Номер карты: {card_number}\n"
+        f"📋 Описание: {description_of_the_problem}\n"
+        f"───────────────────────────────"
+    )
 
-                try:
-                    # Создаем интерактивные кнопки
-                    markup = types.InlineKeyboardMarkup()
-                    approve_button = types.InlineKeyboardButton(
-                        "Возврат оформлен",
-                        callback_data=f'return_approve_{id}_{user_id}'
-                    )
-                    reject_button = types.InlineKeyboardButton(
-                        "Отклонить заявку",
-                        callback_data=f'return_reject_{id}_{user_id}'
-                    )
-                    markup.add(approve_button, reject_button)
-
-                    if photo and os.path.isfile(photo):
-                        try:
-                            with open(photo, 'rb') as photo_file:
-                                sent_message = bot.send_photo(
-                                    CHAT_ID,
-                                    photo_file,
-                                    caption=message,
-                                    reply_markup=markup
-                                )
-                                if sent_message.message_id:
-                                    mark_as_sent(id)
-                        except Exception as e:
-                            print(f"Ошибка при отправке фото: {e}")
-                            bot.send_message(
-                                CHAT_ID,
-                                message + f"\n[Фото не удалось загрузить: {photo}]",
-                                reply_markup=markup
-                            )
-                            mark_as_sent(id)
-                    else:
-                        bot.send_message(
-                            CHAT_ID,
-                            message,
-                            reply_markup=markup
-                        )
-                        mark_as_sent(id)
-                except Exception as e:
-                    print(f"Ошибка при отправке сообщения: {e}")
-                    continue
+    # Создаем интерактивные кнопки
+    markup = types.InlineKeyboardMarkup()
+    approve_button = types.InlineKeyboardButton(
+        "Возврат оформлен",
+        callback_data=f'return_approve_{id}_{user_id}'
+    )
+    reject_button = types.InlineKeyboardButton(
+        "Отклонить заявку",
+        callback_data=f'return_reject_{id}_{user_id}'
+    )
+    markup.add(approve_button, reject_button)
 
-            except Exception as e:
-                print(f"Ошибка при обработке отчета: {e}")
-                continue
+    return {'text': message, 'photo': photo, 'reply_markup': markup}
 
-        time.sleep(60)
+register_outbox_kind('report', DATABASE, 'reports', CHAT_ID, render_report, mark_as_sent)
 
 # =====================================================================================================================
 
@@ -564,10 +660,6 @@ def handle_return_decision(call):
         print(f"Ошибка при обработке callback: {e}")
         bot.answer_callback_query(call.id, "Произошла ошибка")
 
-# Этот процесс работает во втором потоке
-reporting_thread = threading.Thread(target=send_reports)
-reporting_thread.start()
-
 # =====================================================================================================================
 
 def process_refund_amount(message):
@@ -727,7 +819,7 @@ def process_reject_reason(message):
 
 def update_return_status(report_id, status, user_id, refund_amount=None):
     try:
-        with sqlite3.connect(DATABASE) as conn:
+        with get_connection(DATABASE) as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE reports SET returned = ? WHERE id = ?", (status, report_id))
             conn.commit()
@@ -745,23 +837,10 @@ def update_return_status(report_id, status, user_id, refund_amount=None):
 # =====================================================================================================================
 # =====================================================================================================================
 
-# Функция для получения неотправленных отчетов о багах
-def get_unsent_bug_reports():
-    try:
-        with sqlite3.connect(BUGS_DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM bug_reports WHERE sent = 0")
-            return cursor.fetchall()
-    except sqlite3.Error as e:
-        print(f"Ошибка при получении отчетов о багах: {e}")
-        return []
-
-# =====================================================================================================================
-
 # Функция для пометки отчета о баге как отправленного
 def mark_bug_report_as_sent(report_id):
     try:
-        with sqlite3.connect(BUGS_DB) as conn:
+        with get_connection(BUGS_DB) as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE bug_reports SET sent = 1 WHERE id = ?", (report_id,))
             conn.commit()
@@ -770,66 +849,33 @@ def mark_bug_report_as_sent(report_id):
 
 # =====================================================================================================================
 
-# Функция для отправки отчетов о багах
-def send_bug_reports():
-    while True:
-        try:
-            reports = get_unsent_bug_reports()
-            for report in reports:
-                report_id, user_id, bug_description, steps_to_reproduce, os_info, timestamp, sent = report
-
-                message = (
-                    f"📝 Новый отчет о баге #{report_id}\n"
-                    f"───────────────────────────────\n"
-                    f"👤 User ID: {user_id}\n"
-                    f"📅 Дата: {timestamp}\n\n"
-                    f"📝 Описание бага:\n{bug_description}\n\n"
-                    f"🔍 Шаги воспроизведения:\n{steps_to_reproduce}\n\n"
-                    f"💻 ОС: {os_info}\n"
-                    f"───────────────────────────────"
-                )
-
-                try:
-                    bot.send_message(
-                        BUG_AND_FEEDBACK_ID,
-                        message,
-                        parse_mode='Markdown'
-                    )
-                    mark_bug_report_as_sent(report_id)
-                except Exception as e:
-                    print(f"Ошибка при отправке отчета о баге: {e}")
-                    continue
-
-        except Exception as e:
-            print(f"Ошибка в основном цикле отправки отчетов о багах: {e}")
+# Формирование сообщения с отчетом о баге
+def render_bug_report(report):
+    report_id, user_id, bug_description, steps_to_reproduce, os_info, timestamp, sent = report
 
-        time.sleep(60)
+    message = (
+        f"📝 Новый отчет о баге #{report_id}\n"
+        f"───────────────────────────────\n"
+        f"👤 User ID: {user_id}\n"
+        f"📅 Дата: {timestamp}\n\n"
+        f"📝 Описание бага:\n{bug_description}\n\n"
+        f"🔍 Шаги воспроизведения:\n{steps_to_reproduce}\n\n"
+        f"💻 ОС: {os_info}\n"
+        f"───────────────────────────────"
+    )
 
+    return {'text': message, 'parse_mode': 'Markdown'}
 
-# Запускаем поток для отправки отчетов о багах
-bug_reporting_thread = threading.Thread(target=send_bug_reports)
-bug_reporting_thread.start()
+register_outbox_kind('bug_report', BUGS_DB, 'bug_reports', BUG_AND_FEEDBACK_ID, render_bug_report,
+                     mark_bug_report_as_sent)
 
 # =====================================================================================================================
 # =====================================================================================================================
 
-# Функция для получения неотправленных предложений
-def get_unsent_feedback():
-    try:
-        with sqlite3.connect(FEEDBACK_DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM feedback WHERE sent = 0")
-            return cursor.fetchall()
-    except sqlite3.Error as e:
-        print(f"Ошибка при получении предложений: {e}")
-        return []
-
-# =====================================================================================================================
-
 # Функция для пометки предложения как отправленного
 def mark_feedback_as_sent(feedback_id):
     try:
-        with sqlite3.connect(FEEDBACK_DB) as conn:
+        with get_connection(FEEDBACK_DB) as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE feedback SET sent = 1 WHERE id = ?", (feedback_id,))
             conn.commit()
@@ -838,45 +884,29 @@ def mark_feedback_as_sent(feedback_id):
 
 # =====================================================================================================================
 
-# Функция для отправки предложений
-def send_feedback_reports():
-    while True:
-        try:
-            feedbacks = get_unsent_feedback()
-            for feedback in feedbacks:
-                feedback_id, user_id, idea_description, improvement_explanation, examples, timestamp, sent = feedback
-
-                message = (
-                    f"💡 Новое предложение #{feedback_id}\n"
-                    f"───────────────────────────────\n"
-                    f"👤 User ID: {user_id}\n"
-                    f"📅 Дата: {timestamp}\n\n"
-                    f"📝 Описание идеи:\n{idea_description}\n\n"
-                    f"🔄 Как это улучшит сервис:\n{improvement_explanation}\n\n"
-                    f"🌐 Примеры/аналогии:\n{examples}\n"
-                    f"───────────────────────────────"
-                )
+# Формирование сообщения с предложением
+def render_feedback(feedback):
+    feedback_id, user_id, idea_description, improvement_explanation, examples, timestamp, sent = feedback
 
-                try:
-                    bot.send_message(
-                        BUG_AND_FEEDBACK_ID,
-                        message,
-                        parse_mode='Markdown'
-                    )
-                    mark_feedback_as_sent(feedback_id)
-                except Exception as e:
-                    print(f"Ошибка при отправке предложения: {e}")
-                    continue
-
-        except Exception as e:
-            print(f"Ошибка в основном цикле отправки предложений: {e}")
+    message = (
+        f"💡 Новое предложение #{feedback_id}\n"
+        f"───────────────────────────────\n"
+        f"👤 User ID: {user_id}\n"
+        f"📅 Дата: {timestamp}\n\n"
+        f"📝 Описание идеи:\n{idea_description}\n\n"
+        f"🔄 Как это улучшит сервис:\n{improvement_explanation}\n\n"
+        f"🌐 Примеры/аналогии:\n{examples}\n"
+        f"───────────────────────────────"
+    )
 
-        time.sleep(60)
+    return {'text': message, 'parse_mode': 'Markdown'}
 
+register_outbox_kind('feedback', FEEDBACK_DB, 'feedback', BUG_AND_FEEDBACK_ID, render_feedback,
+                     mark_feedback_as_sent)
 
-# Запускаем поток для отправки предложений
-feedback_thread = threading.Thread(target=send_feedback_reports)
-feedback_thread.start()
+# Один поток отправляет сообщения всех типов
+outbox_thread = threading.Thread(target=send_outbox)
+outbox_thread.start()
 
 # =====================================================================================================================
 # =====================================================================================================================
@@ -1076,7 +1106,7 @@ def process_os_info(message):
     bug_report_states[user_id]['data']['os_info'] = message.text
 
     try:
-        with sqlite3.connect(BUGS_DB) as conn:
+        with get_connection(BUGS_DB) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO bug_reports (user_id, bug_description, steps_to_reproduce, os_info)
@@ -1088,6 +1118,7 @@ def process_os_info(message):
                 bug_report_states[user_id]['data']['os_info']
             ))
             conn.commit()
+        enqueue_committed('bug_report', cursor.lastrowid)
     except sqlite3.Error as e:
         print(f"Error saving bug report: {e}")
         bot.send_message(message.chat.id, "Произошла ошибка при сохранении отчета. Пожалуйста, попробуйте позже.")
@@ -1199,7 +1230,7 @@ def process_examples(message):
     feedback_states[user_id]['data']['examples'] = message.text
 
     try:
-        with sqlite3.connect(FEEDBACK_DB) as conn:
+        with get_connection(FEEDBACK_DB) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO feedback (user_id, idea_description, improvement_explanation, examples)
@@ -1211,6 +1242,7 @@ def process_examples(message):
                 feedback_states[user_id]['data']['examples']
             ))
             conn.commit()
+        enqueue_committed('feedback', cursor.lastrowid)
     except sqlite3.Error as e:
         print(f"Error saving feedback: {e}")
         bot.send_message(message.chat.id, "Произошла ошибка при сохранении предложения. Пожалуйста, попробуйте позже.")
@@ -1824,9 +1856,7 @@ def process_description(message, scooter_number, phone_number, card_number, rent
 # =====================================================================================================================
 
 def save_report(photo, scooter_number, phone_number, card_number, rental_time, description, user_id):
-    conn = None
-    try:
-        conn = sqlite3.connect(DATABASE)
+    with get_connection(DATABASE) as conn:
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -1842,12 +1872,10 @@ def save_report(photo, scooter_number, phone_number, card_number, rental_time, d
             VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', (photo, scooter_number, phone_number, card_number, rental_time, description, user_id))
 
-        conn.commit()
-    except Exception as e:
-        raise e
-    finally:
-        if conn:
-            conn.close()
+        # Заявка и запись outbox фиксируются одной транзакцией
+        enqueue_outbox(conn, 'report', cursor.lastrowid)
+
+    notify_outbox()
 
 # =====================================================================================================================
 # =====================================================================================================================
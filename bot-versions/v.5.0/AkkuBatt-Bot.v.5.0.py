@@ -3,33 +3,189 @@
 # ===============================================
 
 import telebot
+import functools
 import os
 import threading
 import time
 import re
+import json
+import hmac
+import hashlib
+import queue
+import sqlite3
+import socket
+import uuid
 import pytz
+import requests
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from telebot import types
-from flask import Flask, Response
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
+from flask import Flask, Response, request
 from apscheduler.schedulers.background import BackgroundScheduler
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, monitoring
 from bson.objectid import ObjectId
+from report_validators import validate_digits, validate_phone_number, validate_rental_time
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# =======================================
+# =============== Метрики ===============
+# =======================================
+
+# Время обработки входящих сообщений по обработчикам
+HANDLER_LATENCY = Histogram('bot_handler_seconds', 'Время работы обработчика сообщения', ['handler'])
+
+# Вызовы Telegram Bot API
+TELEGRAM_CALLS = Counter('bot_telegram_calls_total', 'Вызовы Telegram Bot API', ['method', 'status'])
+TELEGRAM_LATENCY = Histogram('bot_telegram_call_seconds', 'Время вызова Telegram Bot API', ['method'])
+TELEGRAM_RATE_LIMITED = Counter('bot_telegram_rate_limited_total', 'Ответы 429 от Telegram Bot API', ['method'])
+
+# Команды MongoDB
+MONGO_LATENCY = Histogram('bot_mongo_command_seconds', 'Время выполнения команды MongoDB', ['command', 'status'])
+
+# Очередь неотправленных отчётов, значения считаются при каждом запросе /metrics
+OUTBOX_BACKLOG = Gauge('bot_outbox_backlog', 'Количество неотправленных отчётов')
+OUTBOX_OLDEST_AGE = Gauge('bot_outbox_oldest_age_seconds', 'Возраст самого старого неотправленного отчёта')
+
+# Сообщения, отброшенные защитой от флуда
+FLOOD_DROPPED = Counter('bot_flood_dropped_total', 'Сообщения сверх лимита пользователя', ['kind'])
+
+# Фото, ожидающие фоновой загрузки
+PHOTO_INGEST_BACKLOG = Gauge('bot_photo_ingest_backlog', 'Фото в очереди на скачивание')
+
+# Итоги очистки папки photos по файлам: deleted, retained, error
+PHOTO_CLEANUP = Counter('bot_photo_cleanup_files_total', 'Файлы, обработанные очисткой папки photos', ['result'])
+
+# Воронка заявки на возврат: сколько пользователей прошли каждый шаг
+REFUND_FUNNEL_STEPS = ['started', 'photo', 'rental_time', 'scooter_number', 'phone_number', 'card_number', 'description']
+REFUND_FUNNEL = Counter('bot_refund_funnel_total', 'Пройденные шаги заявки на возврат', ['step'])
+for step in REFUND_FUNNEL_STEPS:
+    REFUND_FUNNEL.labels(step)
+
+def timed_handler(handler):
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        with HANDLER_LATENCY.labels(handler.__name__).time():
+            return handler(*args, **kwargs)
+    return wrapper
+
+# Все методы Bot API проходят через apihelper._make_request
+telegram_make_request = telebot.apihelper._make_request
+
+def timed_make_request(token, method_name, *args, **kwargs):
+    status = 'ok'
+    start = time.perf_counter()
+    try:
+        return telegram_make_request(token, method_name, *args, **kwargs)
+    except telebot.apihelper.ApiTelegramException as e:
+        status = str(e.error_code)
+        if e.error_code == 429:
+            TELEGRAM_RATE_LIMITED.labels(method_name).inc()
+        raise
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        TELEGRAM_LATENCY.labels(method_name).observe(time.perf_counter() - start)
+        TELEGRAM_CALLS.labels(method_name, status).inc()
+
+telebot.apihelper._make_request = timed_make_request
+
+class MongoMetricsListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(event.command_name, 'ok').observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_LATENCY.labels(event.command_name, 'error').observe(event.duration_micros / 1e6)
 
 # =================================================
 # =============== КОНФИГУРАЦИЯ БОТА ===============
 # =================================================
 
 API_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
+CHAT_ID = int(os.environ.get('TELEGRAM_CHAT_ID', 0))  # сравнивается с message.chat.id на каждом сообщении
 MONGODB_URI = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
 DATABASE_NAME = os.environ.get('DATABASE_NAME', 'AkkuBattBotSup')
 PHOTOS_DIR = os.environ.get('PHOTOS_DIR', 'photos')
-
-client = MongoClient(MONGODB_URI)
+REPORTS_SWEEP_INTERVAL = int(os.environ.get('REPORTS_SWEEP_INTERVAL', 300))
+REPORTS_BATCH_SIZE = int(os.environ.get('REPORTS_BATCH_SIZE', 50))
+REPORT_CLAIM_TTL = int(os.environ.get('REPORT_CLAIM_TTL', 120))  # секунд на отправку захваченного отчёта
+REPLICA_ID = os.environ.get('REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))  # сообщений в секунду
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 20))  # сообщений в минуту в один чат
+REPORT_ID_BLOCK_SIZE = int(os.environ.get('REPORT_ID_BLOCK_SIZE', 20))
+STATE_STORAGE = os.environ.get('STATE_STORAGE', 'mongo')  # mongo, sqlite или memory
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'DialogStates.db')
+DIALOG_TTL = int(os.environ.get('DIALOG_TTL', 86400))
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')  # polling или webhook
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # например https://bot.example.com/webhook
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 8))  # потоки обработчиков в режиме webhook
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000))
+ARCHIVE_PHOTOS = os.environ.get('ARCHIVE_PHOTOS', '0') == '1'  # сохранять копии фото в PHOTOS_DIR
+PHOTO_RETENTION = int(os.environ.get('PHOTO_RETENTION', 86400))  # секунд хранения фото после отправки заявки
+PHOTO_CLEANUP_INTERVAL = int(os.environ.get('PHOTO_CLEANUP_INTERVAL', 60))  # секунд между порциями очистки
+PHOTO_CLEANUP_CHUNK = int(os.environ.get('PHOTO_CLEANUP_CHUNK', 200))  # файлов за одну порцию
+PHOTO_FSYNC = os.environ.get('PHOTO_FSYNC', '0') == '1'  # сбрасывать фото на диск до переименования
+PHOTO_MAX_BYTES = int(os.environ.get('PHOTO_MAX_BYTES', 10 * 1024 * 1024))
+PHOTO_DOWNLOAD_TIMEOUT = float(os.environ.get('PHOTO_DOWNLOAD_TIMEOUT', 30))  # секунд на всё скачивание
+PHOTO_CHUNK_SIZE = 64 * 1024
+PHOTO_INGEST_WORKERS = int(os.environ.get('PHOTO_INGEST_WORKERS', 2))
+PHOTO_INGEST_QUEUE_SIZE = int(os.environ.get('PHOTO_INGEST_QUEUE_SIZE', 500))
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')  # адрес локального fake_telegram.py для тестов
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 16))  # потоки обработчиков в режиме polling
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', 5))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get('TELEGRAM_READ_TIMEOUT', 15))
+MONGO_TIMEOUT_MS = int(os.environ.get('MONGO_TIMEOUT_MS', 5000))  # выбор сервера и подключение
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 30000))
+FLOOD_TEXT_RATE = float(os.environ.get('FLOOD_TEXT_RATE', 30))  # сообщений в минуту от одного пользователя
+FLOOD_TEXT_BURST = int(os.environ.get('FLOOD_TEXT_BURST', 10))
+FLOOD_MEDIA_RATE = float(os.environ.get('FLOOD_MEDIA_RATE', 6))  # фото и видео в минуту
+FLOOD_MEDIA_BURST = int(os.environ.get('FLOOD_MEDIA_BURST', 3))  # альбом считается одним событием
+FLOOD_MAX_USERS = int(os.environ.get('FLOOD_MAX_USERS', 100000))
+REFUND_LIMIT_PER_PHONE = int(os.environ.get('REFUND_LIMIT_PER_PHONE', 3))
+REFUND_LIMIT_WINDOW = int(os.environ.get('REFUND_LIMIT_WINDOW', 86400))  # секунд
+HEALTH_PROBE_INTERVAL = int(os.environ.get('HEALTH_PROBE_INTERVAL', 15))
+DISPATCHER_MAX_IDLE = int(os.environ.get('DISPATCHER_MAX_IDLE', 2 * REPORTS_SWEEP_INTERVAL))
+
+# Зависший запрос к базе не должен навсегда занимать поток обработчика
+client = MongoClient(MONGODB_URI, event_listeners=[MongoMetricsListener()],
+                     serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+                     connectTimeoutMS=MONGO_TIMEOUT_MS,
+                     socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS)
 db = client[DATABASE_NAME]
 reports_collection = db['reports']
 
-bot = telebot.TeleBot(API_TOKEN, threaded=True)
+# Подмена адреса Bot API для офлайн-тестов
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip('/') + '/file/bot{0}/{1}'
+
+# Таймауты обычных вызовов Bot API; длинный опрос getUpdates задаёт свой таймаут сам
+telebot.apihelper.CONNECT_TIMEOUT = TELEGRAM_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = TELEGRAM_READ_TIMEOUT
+
+# Диалоги хранятся в dialog_states, поэтому поток занят только на время одного обработчика.
+# В режиме webhook обработчики выполняют сами потоки webhook_worker: у пула telebot очередь не ограничена,
+# и через него webhook_queue опустошалась бы сразу, не давая сработать ответу 503
+bot = telebot.TeleBot(API_TOKEN, threaded=BOT_MODE != 'webhook', num_threads=BOT_WORKERS,
+                      use_class_middlewares=True)
+
+# Данные самого бота запрашиваются у Telegram один раз и затем берутся из памяти
+bot_user = None
+bot_user_lock = threading.Lock()
+
+def get_bot_user(refresh=False):
+    global bot_user
+    if bot_user is not None and not refresh:
+        return bot_user
+    with bot_user_lock:
+        if bot_user is None or refresh:
+            bot_user = bot.get_me()
+        return bot_user
 
 # ==============================================
 # =============== ЗАПУСК СЕРВЕРА ===============
@@ -41,6 +197,166 @@ app = Flask(__name__)
 def health_check():
     return Response("OK", status=200)
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), status=200, content_type=CONTENT_TYPE_LATEST)
+
+def get_outbox_backlog():
+    try:
+        return db.reports.count_documents({"sent": 0}, maxTimeMS=1000)
+    except Exception as e:
+        print(f"Ошибка при подсчёте неотправленных отчетов: {e}")
+        return float('nan')
+
+def get_outbox_oldest_age():
+    try:
+        oldest = db.reports.find_one({"sent": 0}, {"_id": 0, "created_at": 1},
+                                     sort=[("created_at", 1)], max_time_ms=1000)
+    except Exception as e:
+        print(f"Ошибка при поиске самого старого отчета: {e}")
+        return float('nan')
+    if not oldest:
+        return 0
+    return (datetime.now() - oldest["created_at"]).total_seconds()
+
+OUTBOX_BACKLOG.set_function(get_outbox_backlog)
+OUTBOX_OLDEST_AGE.set_function(get_outbox_oldest_age)
+
+# ================================================
+# =============== Проверки живости ===============
+# ================================================
+
+# Сетевые проверки выполняет фоновый поток, а /ready и /live только читают результаты из памяти.
+# Планировщик и поток отправки регистрируются здесь при создании.
+probe_state = {
+    'mongo_ok': False,
+    'mongo_checked_at': 0.0,
+    'telegram_ok': False,
+    'telegram_checked_at': 0.0,
+    'dispatcher_loop_at': None,  # конец последнего прохода отправки
+    'dispatcher_success_at': None,  # конец последнего прохода без ошибок
+    'dispatcher_thread': None,
+    'scheduler': None,
+}
+
+def run_health_probes():
+    while True:
+        try:
+            client.admin.command('ping')
+            probe_state['mongo_ok'] = True
+        except Exception as e:
+            probe_state['mongo_ok'] = False
+            print(f"Ошибка проверки MongoDB: {e}")
+        probe_state['mongo_checked_at'] = time.time()
+
+        try:
+            bot.get_me()
+            probe_state['telegram_ok'] = True
+        except Exception as e:
+            probe_state['telegram_ok'] = False
+            print(f"Ошибка проверки Telegram: {e}")
+        probe_state['telegram_checked_at'] = time.time()
+
+        time.sleep(HEALTH_PROBE_INTERVAL)
+
+def seconds_since(timestamp, now):
+    return None if timestamp is None else round(now - timestamp, 3)
+
+def dispatcher_alive(now):
+    thread = probe_state['dispatcher_thread']
+    loop_at = probe_state['dispatcher_loop_at']
+    return (thread is not None and thread.is_alive()
+            and loop_at is not None and now - loop_at < DISPATCHER_MAX_IDLE)
+
+def check_response(ok, checks):
+    return Response(json.dumps({"ok": ok, **checks}), status=200 if ok else 503, mimetype='application/json')
+
+# Процесс жив, пока поток отправки крутит свой цикл; иначе оркестратор перезапускает экземпляр
+@app.route('/live', methods=['GET'])
+def live_check():
+    now = time.time()
+    ok = dispatcher_alive(now)
+    return check_response(ok, {
+        "dispatcher": ok,
+        "dispatcher_loop_age": seconds_since(probe_state['dispatcher_loop_at'], now),
+    })
+
+# Экземпляр готов принимать трафик, если все зависимости доступны и отчёты уходят без ошибок
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    now = time.time()
+    # Результат проверки считается устаревшим, если фоновый поток пропустил несколько проходов
+    max_probe_age = 3 * HEALTH_PROBE_INTERVAL
+    scheduler = probe_state['scheduler']
+    success_at = probe_state['dispatcher_success_at']
+
+    checks = {
+        "mongo": probe_state['mongo_ok'] and now - probe_state['mongo_checked_at'] < max_probe_age,
+        "telegram": probe_state['telegram_ok'] and now - probe_state['telegram_checked_at'] < max_probe_age,
+        "scheduler": scheduler is not None and scheduler.running,
+        "dispatcher": (dispatcher_alive(now)
+                       and success_at is not None and now - success_at < DISPATCHER_MAX_IDLE),
+    }
+    return check_response(all(checks.values()), {
+        **checks,
+        "dispatcher_success_age": seconds_since(success_at, now),
+        "mongo_checked_age": seconds_since(probe_state['mongo_checked_at'] or None, now),
+        "telegram_checked_age": seconds_since(probe_state['telegram_checked_at'] or None, now),
+    })
+
+threading.Thread(target=run_health_probes, daemon=True).start()
+
+# =======================================
+# =============== Веб-хук ===============
+# =======================================
+
+# Обновления от Telegram принимаются сразу, а обрабатываются пулом потоков
+webhook_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    # В режиме polling очередь никто не разбирает, а без секрета проверка ниже пропустила бы любой запрос
+    if BOT_MODE != 'webhook' or not WEBHOOK_SECRET:
+        return Response("Not Found", status=404)
+
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return Response("Forbidden", status=403)
+
+    try:
+        update = types.Update.de_json(request.get_data(as_text=True))
+    except Exception as e:
+        print(f"Ошибка при разборе обновления: {e}")
+        return Response("Bad Request", status=400)
+
+    try:
+        webhook_queue.put_nowait(update)
+    except queue.Full:
+        # Telegram повторит доставку позже
+        return Response("Busy", status=503)
+
+    return Response("OK", status=200)
+
+def webhook_worker():
+    while True:
+        update = webhook_queue.get()
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            print(f"Ошибка при обработке обновления: {e}")
+        finally:
+            webhook_queue.task_done()
+
+def run_webhook():
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise SystemExit("Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+
+    for _ in range(WEBHOOK_WORKERS):
+        threading.Thread(target=webhook_worker, daemon=True).start()
+
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    flask_thread.join()
+
 def run_flask():
     app.run(host='0.0.0.0', port=5000)
 
@@ -52,8 +368,6 @@ flask_thread.start()
 # ==================================================
 
 # Переменные флагов
-flag = False
-photo_process_flag = False
 last_media_group_id = None
 processed_media_groups = {}
 reject_reason_data = {}
@@ -67,29 +381,105 @@ if not os.path.exists(PHOTOS_DIR):
 # =============== ОЧИСТКА ПАПКИ PHOTOS ===============
 # ====================================================
 
-def clean_photos_dir():
-    try:
-        now = datetime.now(pytz.timezone('Europe/Moscow'))
-        print(f"Попытка очистки папки photos в {now.strftime('%Y-%m-%d %H:%M:%S')}")
+# Обход папки с подпапками через os.scandir, по одному файлу
+def iter_photo_files(directory):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_photo_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+# Папка обходится порциями по PHOTO_CLEANUP_CHUNK файлов раз в PHOTO_CLEANUP_INTERVAL секунд:
+# обход сохраняется между запусками, после конца папки начинается новый проход
+class PhotoCleaner:
+    def __init__(self, directory, chunk_size):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def next_chunk(self):
+        if self.entries is None:
+            self.entries = iter_photo_files(self.directory)
+        chunk = []
+        for entry in self.entries:
+            chunk.append(entry)
+            if len(chunk) == self.chunk_size:
+                return chunk
+        self.entries = None
+        return chunk
+
+    def step(self):
+        # Порции не должны пересекаться, даже если предыдущая затянулась
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.clean(self.next_chunk())
+            self.clean_pathless()
+        except Exception as e:
+            print(f"Ошибка в функции очистки папки photos: {e}")
+            if self.entries is not None:
+                self.entries.close()
+                self.entries = None
+        finally:
+            self.lock.release()
+
+    # Записи без файла остаются, если загрузка не удалась или фото превысило PHOTO_MAX_BYTES.
+    # Удаляются по тем же срокам, что и photo_retained; {"path": None} находит их по индексу path
+    def clean_pathless(self):
+        now = datetime.now()
+        result = photos_collection.delete_many({
+            "path": None,
+            "refs": {"$lte": 0},
+            "created_at": {"$lte": now - timedelta(seconds=DIALOG_TTL)},
+            "$or": [{"released_at": None}, {"released_at": {"$lte": now - timedelta(seconds=PHOTO_RETENTION)}}]
+        })
+        PHOTO_CLEANUP.labels('deleted').inc(result.deleted_count)
 
-        for filename in os.listdir(PHOTOS_DIR):
-            file_path = os.path.join(PHOTOS_DIR, filename)
+    def clean(self, chunk):
+        if not chunk:
+            return
+        now = datetime.now()
+        entries = {entry.path: entry for entry in chunk}
+
+        # Один файл может принадлежать нескольким записям (одинаковое содержимое), храним его, пока нужен хоть одной
+        known, retained = set(), set()
+        for photo in photos_collection.find({"path": {"$in": list(entries)}},
+                                            {"path": 1, "refs": 1, "created_at": 1, "released_at": 1}):
+            known.add(photo["path"])
+            if photo_retained(photo, now):
+                retained.add(photo["path"])
+
+        deleted, kept, errors = [], 0, 0
+        for path, entry in entries.items():
             try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-                    print(f"Удален файл: {file_path}")
+                # Файл без записи мог только что скачаться, запись о нём появится следом
+                if path in retained or (path not in known and entry.stat().st_mtime > time.time() - DIALOG_TTL):
+                    kept += 1
+                    continue
+                os.unlink(path)
+                deleted.append(path)
+            except FileNotFoundError:
+                deleted.append(path)
             except Exception as e:
-                print(f"Ошибка при удалении файла {file_path}: {e}")
+                errors += 1
+                print(f"Ошибка при удалении файла {path}: {e}")
 
-        print("Очистка папки photos завершена")
-    except Exception as e:
-        print(f"Ошибка в функции очистки папки photos: {e}")
+        if deleted:
+            photos_collection.delete_many({"path": {"$in": deleted}, "refs": {"$lte": 0}})
+        PHOTO_CLEANUP.labels('deleted').inc(len(deleted))
+        PHOTO_CLEANUP.labels('retained').inc(kept)
+        PHOTO_CLEANUP.labels('error').inc(errors)
 
 
-# Ежедневная очистка в 00:00 по МСК
+photo_cleaner = PhotoCleaner(PHOTOS_DIR, PHOTO_CLEANUP_CHUNK)
+
+# Очистка идёт небольшими порциями в течение всего дня
 scheduler = BackgroundScheduler(timezone=pytz.timezone('Europe/Moscow'))
-scheduler.add_job(clean_photos_dir, 'cron', hour=0, minute=0)
+scheduler.add_job(photo_cleaner.step, 'interval', seconds=PHOTO_CLEANUP_INTERVAL, max_instances=1, coalesce=True)
 scheduler.start()
+probe_state['scheduler'] = scheduler
 
 # ====================================================================
 # =============== Создание и использование базы данных ===============
@@ -106,6 +496,8 @@ def init_mongodb():
                     "id": {"bsonType": "int"},
                     "user_id": {"bsonType": ["int", "long"]},  # Разрешаем оба типа
                     "photo": {"bsonType": "string"},
+                    "photo_unique_id": {"bsonType": ["string", "null"]},
+                    "photo_file_id": {"bsonType": ["string", "null"]},
                     "rental_time": {"bsonType": "string"},
                     "scooter_number": {"bsonType": "string"},
                     "phone_number": {"bsonType": "string"},
@@ -114,14 +506,13 @@ def init_mongodb():
                     "sent": {"bsonType": "int", "minimum": 0, "maximum": 1},
                     "returned": {"bsonType": "int", "minimum": 0, "maximum": 2},
                     "refund_amount": {"bsonType": "double"},
-                    "created_at": {"bsonType": "date"}
+                    "created_at": {"bsonType": "date"},
+                    "claimed_by": {"bsonType": "string"},
+                    "claim_expires": {"bsonType": "date"}
                 }
             }
         })
 
-        # Создаем индекс для автоинкремента id
-        db.reports.create_index("id", unique=True)
-
         # Создаем последовательность для автоинкремента
         if "counters" not in db.list_collection_names():
             db.counters.insert_one({
@@ -133,17 +524,410 @@ def init_mongodb():
         # Коллекция уже существует
         print(f"MongoDB collection already exists: {e}")
 
-# Функция для получения следующего ID
-def get_next_sequence_value(sequence_name):
+    ensure_indexes()
+
+# ===============================================
+# =============== Индексы MongoDB ===============
+# ===============================================
+
+# Все индексы коллекций описаны здесь: (коллекция, ключи, параметры)
+INDEXES = [
+    # Автоинкремент id
+    ("reports", [("id", 1)], {"unique": True}),
+    # Подсчёт отчетов по номеру телефона, в том числе за последние сутки
+    ("reports", [("phone_number", 1), ("created_at", 1)], {}),
+    # Очередь неотправленных отчётов: в индекс попадают только документы с sent = 0,
+    # поэтому его размер зависит от числа ожидающих заявок, а не от всей истории
+    ("reports", [("created_at", 1)], {"name": "pending_by_created_at", "partialFilterExpression": {"sent": 0}}),
+    # Поиск записей о фото по файлам при очистке папки photos
+    ("photos", [("path", 1)], {}),
+    # Привязка скачанного фото к заявкам
+    ("reports", [("photo_unique_id", 1)], {}),
+]
+
+# Индексы прошлых версий, которые перекрыты составными: (коллекция, имя)
+OBSOLETE_INDEXES = [
+    # Префикс индекса (phone_number, created_at)
+    ("reports", "phone_number_1"),
+]
+
+# Индексы создаются при каждом запуске (операция идемпотентна),
+# чтобы они появились и в уже существующей коллекции
+def ensure_indexes():
+    for collection, keys, options in INDEXES:
+        try:
+            db[collection].create_index(keys, **options)
+        except Exception as e:
+            print(f"Ошибка при создании индекса {collection} {keys}: {e}")
+
+    for collection, name in OBSOLETE_INDEXES:
+        try:
+            if name in db[collection].index_information():
+                db[collection].drop_index(name)
+        except Exception as e:
+            print(f"Ошибка при удалении индекса {collection} {name}: {e}")
+
+# Функция для получения следующего ID (increment > 1 резервирует сразу несколько)
+def get_next_sequence_value(sequence_name, increment=1):
+    # upsert: счётчик создаётся сам, даже если init_mongodb не засеял db.counters
     counter = db.counters.find_one_and_update(
         {"_id": sequence_name},
-        {"$inc": {"seq": 1}},
-        return_document=True
+        {"$inc": {"seq": increment}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
     return counter["seq"]
 
+# Блоки ID, выделенные этому процессу: имя последовательности -> (следующий ID, последний ID блока)
+id_blocks = {}
+id_blocks_lock = threading.Lock()
+
+# Выдача ID из заранее арендованного блока.
+# Блок резервируется атомарно в db.counters, поэтому несколько экземпляров бота
+# не получат одинаковых ID, а после перезапуска неиспользованный остаток блока просто пропускается.
+def allocate_id(sequence_name):
+    with id_blocks_lock:
+        next_id, last_id = id_blocks.get(sequence_name, (1, 0))
+        if next_id > last_id:
+            last_id = get_next_sequence_value(sequence_name, REPORT_ID_BLOCK_SIZE)
+            next_id = last_id - REPORT_ID_BLOCK_SIZE + 1
+        id_blocks[sequence_name] = (next_id + 1, last_id)
+        return next_id
+
 init_mongodb()
 
+# =================================================
+# =============== Состояния диалога ===============
+# =================================================
+
+# Состояние заявки на возврат хранится отдельно для каждого чата:
+# шаг диалога и уже собранные данные. Хранилище выбирается через STATE_STORAGE.
+
+class MemoryStateStorage:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.states = OrderedDict()  # chat_id -> (истекает, шаг, данные), по возрастанию срока
+        self.lock = threading.Lock()
+
+    # Удаление устаревших диалогов с начала очереди
+    def evict(self, now):
+        while self.states:
+            chat_id, (expires_at, _, _) = next(iter(self.states.items()))
+            if expires_at > now:
+                break
+            del self.states[chat_id]
+
+    def get(self, chat_id):
+        with self.lock:
+            self.evict(time.monotonic())
+            entry = self.states.get(chat_id)
+        if entry is None:
+            return None, {}
+        return entry[1], dict(entry[2])
+
+    def set(self, chat_id, state, data):
+        with self.lock:
+            self.states.pop(chat_id, None)
+            self.states[chat_id] = (time.monotonic() + self.ttl, state, dict(data))
+
+    def delete(self, chat_id):
+        with self.lock:
+            self.states.pop(chat_id, None)
+
+
+class SQLiteStateStorage:
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS dialog_states (
+                chat_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def get(self, chat_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT state, data FROM dialog_states WHERE chat_id = ? AND expires_at > ?",
+                (chat_id, time.time())
+            ).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def set(self, chat_id, state, data):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dialog_states (chat_id, state, data, expires_at) VALUES (?, ?, ?, ?)",
+                (chat_id, state, json.dumps(data), time.time() + self.ttl)
+            )
+            self.conn.commit()
+
+    def delete(self, chat_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM dialog_states WHERE chat_id = ?", (chat_id,))
+            self.conn.commit()
+
+    # Удаление устаревших диалогов (запускается планировщиком)
+    def purge(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM dialog_states WHERE expires_at <= ?", (time.time(),))
+            self.conn.commit()
+
+
+class MongoStateStorage:
+    def __init__(self, collection, ttl):
+        self.collection = collection
+        self.ttl = ttl
+        try:
+            # MongoDB сам удаляет документы после expires_at
+            collection.create_index("expires_at", expireAfterSeconds=0)
+        except Exception as e:
+            print(f"Ошибка при создании индекса состояний диалога: {e}")
+
+    def get(self, chat_id):
+        document = self.collection.find_one({"_id": chat_id, "expires_at": {"$gt": datetime.now(pytz.utc)}})
+        if document is None:
+            return None, {}
+        return document["state"], document["data"]
+
+    def set(self, chat_id, state, data):
+        self.collection.replace_one(
+            {"_id": chat_id},
+            {"state": state, "data": data, "expires_at": datetime.now(pytz.utc) + timedelta(seconds=self.ttl)},
+            upsert=True
+        )
+
+    def delete(self, chat_id):
+        self.collection.delete_one({"_id": chat_id})
+
+
+def create_state_storage():
+    if STATE_STORAGE == 'memory':
+        return MemoryStateStorage(DIALOG_TTL)
+    if STATE_STORAGE == 'sqlite':
+        storage = SQLiteStateStorage(STATE_DB_PATH, DIALOG_TTL)
+        scheduler.add_job(storage.purge, 'interval', hours=1)
+        return storage
+    return MongoStateStorage(db['dialog_states'], DIALOG_TTL)
+
+dialog_states = create_state_storage()
+
+def get_dialog(chat_id):
+    try:
+        return dialog_states.get(chat_id)
+    except Exception as e:
+        print(f"Ошибка при получении состояния диалога: {e}")
+        return None, {}
+
+def set_dialog(chat_id, state, data=None):
+    dialog_states.set(chat_id, state, data or {})
+
+def reset_dialog(chat_id):
+    try:
+        dialog_states.delete(chat_id)
+    except Exception as e:
+        print(f"Ошибка при сбросе состояния диалога: {e}")
+
+# Состояние, сохранённое в сообщении фильтром in_dialog_step; хранилище запрашивается, только если его нет
+def message_dialog(message):
+    dialog = getattr(message, 'dialog', None)
+    if dialog is None:
+        dialog = get_dialog(message.chat.id)
+        message.dialog = dialog
+    return dialog
+
+# Выход из заявки по кнопке меню: запись в хранилище удаляется, только если диалог был начат
+def leave_dialog(message):
+    state, _ = message_dialog(message)
+    if state is not None:
+        reset_dialog(message.chat.id)
+        message.dialog = (None, {})
+
+# ==============================================
+# =============== Хранилище фото ===============
+# ==============================================
+
+# Фото хранятся под SHA-256 содержимого, а в коллекции photos учитываются по file_unique_id.
+# refs — число неотправленных заявок, ссылающихся на фото; released_at — когда отправлена последняя из них.
+photos_collection = db['photos']
+
+# Подпапки из первых символов хеша: photos/ab/cd/abcd….jpg, в каждой папке остаётся немного файлов
+def photo_path_for(content_hash):
+    return os.path.join(PHOTOS_DIR, content_hash[:2], content_hash[2:4], f"{content_hash}.jpg")
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Фото пишется по частям во временный файл и переименовывается целиком,
+# поэтому под итоговым именем никогда не лежит недописанный файл.
+# Хеш считается на лету, в памяти одновременно держится только одна часть.
+def save_photo_stream(chunks):
+    temp_path = os.path.join(PHOTOS_DIR, f".{uuid.uuid4().hex}.tmp")
+    content_hash = hashlib.sha256()
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            for chunk in chunks:
+                content_hash.update(chunk)
+                temp_file.write(chunk)
+            if PHOTO_FSYNC:
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+
+        photo_path = photo_path_for(content_hash.hexdigest())
+        os.makedirs(os.path.dirname(photo_path), exist_ok=True)
+        os.replace(temp_path, photo_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    if PHOTO_FSYNC:
+        fsync_directory(os.path.dirname(photo_path))
+    return photo_path, content_hash.hexdigest()
+
+# Потоковое скачивание файла из Telegram с ограничением размера и общего времени.
+# Запрос идёт мимо apihelper._make_request, поэтому метрики вызова пишутся здесь же под методом downloadFile
+def download_photo_chunks(file_path):
+    file_url = telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}"
+    deadline = time.monotonic() + PHOTO_DOWNLOAD_TIMEOUT
+    status = 'ok'
+    start = time.perf_counter()
+    try:
+        with requests.get(file_url.format(API_TOKEN, file_path), stream=True, proxies=telebot.apihelper.proxy,
+                          timeout=(TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)) as response:
+            if not response.ok:
+                status = str(response.status_code)
+            response.raise_for_status()
+            if int(response.headers.get('Content-Length') or 0) > PHOTO_MAX_BYTES:
+                raise ValueError("фото слишком большое")
+
+            received = 0
+            for chunk in response.iter_content(chunk_size=PHOTO_CHUNK_SIZE):
+                received += len(chunk)
+                if received > PHOTO_MAX_BYTES:
+                    raise ValueError("фото слишком большое")
+                if time.monotonic() > deadline:
+                    raise TimeoutError("истекло время загрузки фото")
+                yield chunk
+    except BaseException:
+        # Сюда же попадает прерванная запись на диск (GeneratorExit)
+        if status == 'ok':
+            status = 'error'
+        raise
+    finally:
+        TELEGRAM_LATENCY.labels('downloadFile').observe(time.perf_counter() - start)
+        TELEGRAM_CALLS.labels('downloadFile', status).inc()
+
+def store_photo(photo_size):
+    # Повторно присланное фото заново не скачиваем
+    stored = photos_collection.find_one({"_id": photo_size.file_unique_id})
+    if stored and stored.get("path") and os.path.isfile(stored["path"]):
+        return stored["path"]
+
+    if photo_size.file_size and photo_size.file_size > PHOTO_MAX_BYTES:
+        raise ValueError("фото слишком большое")
+
+    photo_file = bot.get_file(photo_size.file_id)
+    photo_path, content_hash = save_photo_stream(download_photo_chunks(photo_file.file_path))
+
+    photos_collection.update_one(
+        {"_id": photo_size.file_unique_id},
+        {
+            "$set": {"path": photo_path, "sha256": content_hash},
+            "$setOnInsert": {"refs": 0, "created_at": datetime.now()}
+        },
+        upsert=True
+    )
+    return photo_path
+
+# Заявка начала ссылаться на фото. Фото может ещё скачиваться, тогда запись создаётся заранее
+def acquire_photo(file_unique_id):
+    # Без архива коллекция photos не ведётся
+    if not ARCHIVE_PHOTOS or not file_unique_id:
+        return
+    # Заявка к этому моменту уже сохранена: ошибка учёта фото не должна выглядеть для пользователя как отказ
+    try:
+        photos_collection.update_one(
+            {"_id": file_unique_id},
+            {"$inc": {"refs": 1}, "$setOnInsert": {"created_at": datetime.now()}},
+            upsert=True
+        )
+    except Exception as e:
+        print(f"Ошибка при учёте фото: {e}")
+
+# Заявка отправлена, фото ей больше не нужно
+def release_photo(file_unique_id):
+    if not ARCHIVE_PHOTOS or not file_unique_id:
+        return
+    try:
+        photos_collection.update_one({"_id": file_unique_id},
+                                     {"$inc": {"refs": -1}, "$set": {"released_at": datetime.now()}})
+    except Exception as e:
+        print(f"Ошибка при освобождении фото: {e}")
+
+# Срок хранения фото зависит от состояния заявки: пока заявка не отправлена — бессрочно,
+# пока диалог может продолжиться — DIALOG_TTL, после отправки заявки — PHOTO_RETENTION
+def photo_retained(photo, now):
+    if photo.get("refs", 0) > 0:
+        return True
+    created_at = photo.get("created_at")
+    if created_at and created_at > now - timedelta(seconds=DIALOG_TTL):
+        return True
+    released_at = photo.get("released_at")
+    return released_at is not None and released_at > now - timedelta(seconds=PHOTO_RETENTION)
+
+# =====================================================
+# =============== Фоновая загрузка фото ===============
+# =====================================================
+
+# Фото скачиваются отдельными потоками, диалог заявки продолжается сразу по file_id
+photo_ingest_queue = queue.Queue(maxsize=PHOTO_INGEST_QUEUE_SIZE)
+PHOTO_INGEST_BACKLOG.set_function(photo_ingest_queue.qsize)
+
+def enqueue_photo(photo_size):
+    try:
+        photo_ingest_queue.put_nowait(photo_size)
+    except queue.Full:
+        # Отчёт всё равно уйдёт администраторам по file_id, теряется только копия в PHOTOS_DIR
+        print(f"Очередь загрузки фото переполнена, фото {photo_size.file_unique_id} не сохранено")
+
+# Проставляет путь к скачанному фото в заявках, созданных до окончания загрузки
+def link_stored_photo(file_unique_id):
+    try:
+        stored = photos_collection.find_one({"_id": file_unique_id}, {"path": 1})
+        if stored and stored.get("path"):
+            db.reports.update_many({"photo_unique_id": file_unique_id, "photo": ""},
+                                   {"$set": {"photo": stored["path"]}})
+    except Exception as e:
+        print(f"Ошибка при привязке фото к заявке: {e}")
+
+def photo_ingest_worker():
+    while True:
+        photo_size = photo_ingest_queue.get()
+        try:
+            store_photo(photo_size)
+            link_stored_photo(photo_size.file_unique_id)
+        except Exception as e:
+            print(f"Ошибка при загрузке фото {photo_size.file_unique_id}: {e}")
+        finally:
+            photo_ingest_queue.task_done()
+
+
+if ARCHIVE_PHOTOS:
+    for _ in range(PHOTO_INGEST_WORKERS):
+        threading.Thread(target=photo_ingest_worker, daemon=True).start()
+
 # ======================================
 # =============== ТЕКСТА ===============
 # ======================================
@@ -327,126 +1111,419 @@ ScooterControlsText = (
     'Для вашей безопасности используйте фару в любое время суток.'
 )
 
+# ==========================================
+# =============== Клавиатуры ===============
+# ==========================================
+
+# Клавиатура собирается и сериализуется в JSON один раз при запуске.
+# Telebot передаёт строку в reply_markup без повторной сериализации.
+def build_keyboard(*rows):
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    for row in rows:
+        markup.add(*[types.KeyboardButton(text) for text in row])
+    return markup.to_json()
+
+MAIN_MENU_KEYBOARD = build_keyboard(
+    ["Почему списалось 300₽❓", "Проблема с самокатом❓"],
+    ["Как арендовать самокат❓", "Как завершить поездку❓"],
+)
+BACK_TO_MENU_KEYBOARD = build_keyboard(["В главное меню"])
+WHERE_MONEY_KEYBOARD = build_keyboard(["💸 Не пришёл возврат?"], ["В главное меню"])
+RENT_TUTORIAL_KEYBOARD = build_keyboard(
+    ["🛴 Как установить приложение?", "🛴 Как арендовать самокат?"],
+    ["🛴 Как кататься?", "⚠️ Разрешенные зоны для катания"],
+    ["В главное меню"],
+)
+RENT_TUTORIAL_BACK_KEYBOARD = build_keyboard(["🔙 Назад", "В главное меню"])
+GREEN_ZONE_KEYBOARD = build_keyboard(["В главное меню"], ["🔙 Назад"])
+STOP_RENT_KEYBOARD = build_keyboard(
+    ["⚠️ Как завершить аренду?", "⚠️ Нет кнопки завершить"],
+    ["В главное меню"],
+)
+STOP_RENT_BACK_KEYBOARD = build_keyboard(["В главное меню"], ["🔙 Нaзaд"])
+PROBLEM_KEYBOARD = build_keyboard(
+    ["Нужен возврат❓", "⚠️ Самoкат перестал ехать"],
+    ["🛴 Cамокат едет медленно?", "Не нашли что искали❓"],
+    ["В главное меню"],
+)
+PROBLEM_BACK_KEYBOARD = build_keyboard(["В главное меню"], ["🔙 Haзaд"])
+SCOOTER_CONTROLS_KEYBOARD = build_keyboard(["🔙 Haзaд", "В главное меню"])
+
 # ============================================
 # =============== Парсинг базы ===============
 # ============================================
 
-# Парсинг базы на неотправленные отчёты
+# Поля отчёта, которые нужны для отправки администраторам
+REPORT_FIELDS = {
+    "_id": 0,
+    "id": 1,
+    "user_id": 1,
+    "photo": 1,
+    "photo_file_id": 1,
+    "photo_unique_id": 1,
+    "rental_time": 1,
+    "scooter_number": 1,
+    "phone_number": 1,
+    "card_number": 1,
+    "description_of_the_problem": 1,
+}
+
+# Отчёт свободен, если его никто не захватил или захват истёк (реплика упала во время отправки)
+def unclaimed(now):
+    return {"claim_expires": {"$not": {"$gte": now}}}
+
+# Парсинг базы на неотправленные отчёты: курсор по частичному индексу отдаёт их пачками
 def get_reports():
-    try:
-        reports = list(db.reports.find({"sent": 0}).sort("created_at", 1))
-        return reports
-    except Exception as e:
-        print(f"Ошибка при получении отчетов: {e}")
-        return []
+    query = {"sent": 0, **unclaimed(datetime.now())}
+    cursor = db.reports.find(query, REPORT_FIELDS).sort("created_at", 1).batch_size(REPORTS_BATCH_SIZE)
+    batch = []
+    for report in cursor:
+        batch.append(report)
+        if len(batch) == REPORTS_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 # =================================================
 # =============== Получение отчетов ===============
 # =================================================
 
+# Атомарно захватывает отчёт для отправки этой репликой.
+# Возвращает False, если его уже отправила или отправляет другая реплика.
+def claim_report(report_id):
+    now = datetime.now()
+    try:
+        claimed = db.reports.find_one_and_update(
+            {"id": report_id, "sent": 0, **unclaimed(now)},
+            {"$set": {"claimed_by": REPLICA_ID, "claim_expires": now + timedelta(seconds=REPORT_CLAIM_TTL)}},
+            projection={"_id": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return claimed is not None
+    except Exception as e:
+        print(f"Ошибка при захвате отчета: {e}")
+        return False
+
 # Подготовка данных для отправки отчёта
+# Возвращает True, если отчёт был отмечен именно этим вызовом
 def mark_as_sent(report_id):
     try:
-        db.reports.update_one(
-            {"id": report_id},
-            {"$set": {"sent": 1}}
+        result = db.reports.update_one(
+            {"id": report_id, "sent": 0, "claimed_by": REPLICA_ID},
+            {"$set": {"sent": 1}, "$unset": {"claim_expires": ""}}
         )
+        if result.modified_count != 1:
+            print(f"Отчет {report_id} уже отмечен или захвачен другой репликой")
+        return result.modified_count == 1
     except Exception as e:
         print(f"Ошибка при обновлении отчета: {e}")
+        return False
 
 # =======================================================
 # =============== Кол-во отчетов с номера ===============
 # =======================================================
 
-def get_report_count_by_phone(phone_number):
+def get_report_count_by_phone(phone_number, since=None):
+    query = {"phone_number": phone_number}
+    if since is not None:
+        query["created_at"] = {"$gte": since}
     try:
-        return db.reports.count_documents({"phone_number": phone_number})
+        return db.reports.count_documents(query)
     except Exception as e:
         print(f"Ошибка при получении количества отчетов: {e}")
         return 1
 
+# Количество отчетов сразу для нескольких номеров одним запросом
+def get_report_counts_by_phones(phone_numbers):
+    phone_numbers = list(set(phone_numbers))
+    try:
+        counts = {phone_number: 0 for phone_number in phone_numbers}
+        for row in db.reports.aggregate([
+            {"$match": {"phone_number": {"$in": phone_numbers}}},
+            {"$group": {"_id": "$phone_number", "count": {"$sum": 1}}}
+        ]):
+            counts[row["_id"]] = row["count"]
+        return counts
+    except Exception as e:
+        print(f"Ошибка при получении количества отчетов: {e}")
+        return {phone_number: 1 for phone_number in phone_numbers}
+
+# ====================================================
+# =============== Пробуждение отправки ===============
+# ====================================================
+
+# Событие будит поток отправки сразу после сохранения заявки.
+# Изначально взведено, чтобы при старте отправить накопившиеся отчёты.
+reports_event = threading.Event()
+reports_event.set()
+
+def notify_new_report():
+    reports_event.set()
+
+# ===================================================
+# =============== Ограничение частоты ===============
+# ===================================================
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate  # токенов в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Блокирует поток, пока не появится свободный токен
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Запрещает отправку на указанное время (ответ 429 с retry_after)
+    def pause(self, seconds):
+        with self.lock:
+            self.tokens = 0
+            self.updated = time.monotonic() + seconds
+
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~20 сообщений в минуту в группу
+global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+chat_buckets = {}
+chat_buckets_lock = threading.Lock()
+
+def get_chat_bucket(chat_id):
+    with chat_buckets_lock:
+        if chat_id not in chat_buckets:
+            chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE / 60, 1)
+        return chat_buckets[chat_id]
+
+# Выполняет запрос к Telegram с учётом лимитов и повторяет его после 429
+def send_throttled(chat_id, send):
+    chat_bucket = get_chat_bucket(str(chat_id))
+    while True:
+        chat_bucket.acquire()
+        global_bucket.acquire()
+        try:
+            return send()
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 429:
+                raise
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            print(f"Превышен лимит Telegram для чата {chat_id}, повтор через {retry_after} с")
+            chat_bucket.pause(retry_after)
+
 # ===============================================
-# =============== Отправка отчёта ===============
+# =============== Защита от флуда ===============
 # ===============================================
 
-def send_reports():
-    while True:
-        reports = get_reports()
-        for report in reports:
-            try:
-                report_id = report["id"]
-                user_id = report["user_id"]
-                photo = report.get("photo", "")
-                rent_data = report.get("rental_time", "")
-                scooter_number = report.get("scooter_number", "")
-                phone_number = report.get("phone_number", "")
-                card_number = report.get("card_number", "")
-                description_of_the_problem = report.get("description_of_the_problem", "")
-
-                report_count = get_report_count_by_phone(phone_number)
-
-                message = (
-                    f"📝 Report: #{report_id}\n"
-                    f"───────────────────────────────\n"
-                    f"👤 User ID: {user_id}\n"
-                    f"📱 Номер телефона: {phone_number}\n"
-                    f"🔢 Количество отчетов от этого номера: {report_count}\n"
-                    f"⏱️ Дата и время начала аренды: {rent_data}\n"
-                    f"🛴 Номер самоката: {scooter_number}\n"
-                    f"💳 Номер карты: {card_number}\n"
-                    f"📋 Описание: {description_of_the_problem}\n"
-                    f"───────────────────────────────"
-                )
+# Неблокирующие бакеты по пользователям: ключ -> [токены, время обновления, предупреждён].
+# Давно не писавшие пользователи вытесняются, когда ключей становится больше max_keys.
+class FloodControl:
+    def __init__(self, rate, capacity, max_keys):
+        self.rate = rate  # токенов в секунду
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Возвращает (разрешено, нужно ли предупредить пользователя); предупреждение — одно на серию отказов
+    def allow(self, key):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.capacity, now, False]
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self.buckets.move_to_end(key)
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                bucket[2] = False
+                return True, False
+            warn = not bucket[2]
+            bucket[2] = True
+            return False, warn
+
+
+MEDIA_CONTENT_TYPES = {'photo', 'video', 'document', 'animation', 'video_note', 'voice', 'audio', 'sticker'}
+flood_limits = {
+    'text': FloodControl(FLOOD_TEXT_RATE / 60, FLOOD_TEXT_BURST, FLOOD_MAX_USERS),
+    'media': FloodControl(FLOOD_MEDIA_RATE / 60, FLOOD_MEDIA_BURST, FLOOD_MAX_USERS),
+}
+
+# Проверка выполняется до фильтров обработчиков, лишние сообщения дальше не проходят
+class FloodMiddleware(BaseMiddleware):
+    # Сколько последних альбомов помнить; сообщения одного альбома приходят почти одновременно
+    MEDIA_GROUPS_KEPT = 1000
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message']
+        self.media_groups = OrderedDict()  # media_group_id -> решение по первому сообщению альбома
+        self.lock = threading.Lock()
+
+    # Альбом приходит отдельными сообщениями с общим media_group_id, лимит расходуется один раз на весь альбом
+    def allow(self, kind, user_id, media_group_id):
+        if media_group_id is None:
+            return flood_limits[kind].allow(user_id)
+        with self.lock:
+            if media_group_id in self.media_groups:
+                return self.media_groups[media_group_id], False
+            allowed, warn = flood_limits[kind].allow(user_id)
+            self.media_groups[media_group_id] = allowed
+            if len(self.media_groups) > self.MEDIA_GROUPS_KEPT:
+                self.media_groups.popitem(last=False)
+            return allowed, warn
+
+    def pre_process(self, message, data):
+        # Чат администраторов не ограничиваем
+        if message.chat.id == CHAT_ID:
+            return
 
-                # Создаем интерактивные кнопки
-                markup = types.InlineKeyboardMarkup(row_width=2)
-                approve_button = types.InlineKeyboardButton(
-                    "Подтвердить возврат",
-                    callback_data=f'return_approve_{report_id}_{user_id}'
-                )
-                reject_button = types.InlineKeyboardButton(
-                    "Отклонить заявку",
-                    callback_data=f'return_reject_{report_id}_{user_id}'
-                )
-                # question_button = types.InlineKeyboardButton(
-                #     "Уточняющий вопрос",
-                #     callback_data=f'return_question_{report_id}_{user_id}'
-                # )
-                markup.add(approve_button, reject_button)
-
-                if photo and os.path.isfile(photo):
-                    try:
-                        with open(photo, 'rb') as photo_file:
-                            sent_message = bot.send_photo(
-                                CHAT_ID,
-                                photo_file,
-                                caption=message,
-                                reply_markup=markup
-                            )
-                            if sent_message.message_id:
-                                mark_as_sent(report_id)
-                    except Exception as e:
-                        print(f"Ошибка при отправке фото: {e}")
-                        bot.send_message(
-                            CHAT_ID,
-                            message + f"\n[Фото не удалось загрузить: {photo}]",
-                            reply_markup=markup
-                        )
-                        mark_as_sent(report_id)
-                else:
-                    bot.send_message(
-                        CHAT_ID,
-                        message,
-                        reply_markup=markup
-                    )
-                    mark_as_sent(report_id)
+        kind = 'media' if message.content_type in MEDIA_CONTENT_TYPES else 'text'
+        user_id = message.from_user.id if message.from_user else message.chat.id
+        allowed, warn = self.allow(kind, user_id, message.media_group_id)
+        if allowed:
+            return
 
+        FLOOD_DROPPED.labels(kind).inc()
+        if warn:
+            try:
+                bot.send_message(message.chat.id, "Вы отправляете сообщения слишком часто. "
+                                                  "Пожалуйста, подождите немного и повторите.")
             except Exception as e:
-                print(f"Ошибка при обработке отчета: {e}")
-                continue
+                print(f"Ошибка при отправке предупреждения о флуде: {e}")
+        return CancelUpdate()
+
+    def post_process(self, message, data, exception):
+        pass
+
 
-        time.sleep(60)
+bot.setup_middleware(FloodMiddleware())
+
+# Лимит заявок на возврат с одного номера за окно REFUND_LIMIT_WINDOW
+def refund_limit_reached(phone_number):
+    since = datetime.now() - timedelta(seconds=REFUND_LIMIT_WINDOW)
+    return get_report_count_by_phone(phone_number, since) >= REFUND_LIMIT_PER_PHONE
+
+# ===============================================
+# =============== Отправка отчёта ===============
+# ===============================================
+
+# Формирование текста и кнопок отчёта
+def render_report(report, report_count):
+    report_id = report["id"]
+    user_id = report["user_id"]
+    rent_data = report.get("rental_time", "")
+    scooter_number = report.get("scooter_number", "")
+    phone_number = report.get("phone_number", "")
+    card_number = report.get("card_number", "")
+    description_of_the_problem = report.get("description_of_the_problem", "")
+
+    message = (
+        f"📝 Report: #{report_id}\n"
+        f"───────────────────────────────\n"
+        f"👤 User ID: {user_id}\n"
+        f"📱 Номер телефона: {phone_number}\n"
+        f"🔢 Количество отчетов от этого номера: {report_count}\n"
+        f"⏱️ Дата и время начала аренды: {rent_data}\n"
+        f"🛴 Номер самоката: {scooter_number}\n"
+        f"💳 Номер карты: {card_number}\n"
+        f"📋 Описание: {description_of_the_problem}\n"
+        f"───────────────────────────────"
+    )
+
+    # Создаем интерактивные кнопки
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    approve_button = types.InlineKeyboardButton(
+        "Подтвердить возврат",
+        callback_data=f'return_approve_{report_id}_{user_id}'
+    )
+    reject_button = types.InlineKeyboardButton(
+        "Отклонить заявку",
+        callback_data=f'return_reject_{report_id}_{user_id}'
+    )
+    # question_button = types.InlineKeyboardButton(
+    #     "Уточняющий вопрос",
+    #     callback_data=f'return_question_{report_id}_{user_id}'
+    # )
+    markup.add(approve_button, reject_button)
+
+    return message, markup
+
+# Отправка одного отчёта в чат администраторов
+def deliver_report(report, message, markup):
+    photo = report.get("photo", "")
+    photo_file_id = report.get("photo_file_id")
+
+    if photo_file_id or (photo and os.path.isfile(photo)):
+        def send_photo():
+            # Фото пересылается по file_id без повторной загрузки байтов
+            if photo_file_id:
+                return bot.send_photo(CHAT_ID, photo_file_id, caption=message, reply_markup=markup)
+            with open(photo, 'rb') as photo_file:
+                return bot.send_photo(CHAT_ID, photo_file, caption=message, reply_markup=markup)
+
+        try:
+            send_throttled(CHAT_ID, send_photo)
+            return
+        except Exception as e:
+            print(f"Ошибка при отправке фото: {e}")
+            message += f"\n[Фото не удалось загрузить: {photo_file_id or photo}]"
+
+    send_throttled(CHAT_ID, lambda: bot.send_message(CHAT_ID, message, reply_markup=markup))
+
+def send_reports():
+    while True:
+        # Ждём новую заявку; по таймауту делаем резервный проход по базе
+        reports_event.wait(timeout=REPORTS_SWEEP_INTERVAL)
+        reports_event.clear()
+
+        try:
+            failed = 0
+            for reports in get_reports():
+                failed += send_report_batch(reports)
+                # Длинная очередь не должна выглядеть как зависший поток
+                probe_state['dispatcher_loop_at'] = time.time()
+            # Успешный проход — всё захваченное доставлено или очередь пуста; иначе /ready перестанет отвечать 200
+            if not failed:
+                probe_state['dispatcher_success_at'] = time.time()
+        except Exception as e:
+            print(f"Ошибка при получении отчетов: {e}")
+        probe_state['dispatcher_loop_at'] = time.time()
+
+# Возвращает число отчётов, которые не удалось доставить
+def send_report_batch(reports):
+    # Количество отчётов по каждому номеру получаем одним запросом для всей пачки
+    report_counts = get_report_counts_by_phones(report.get("phone_number", "") for report in reports)
+
+    failed = 0
+    for report in reports:
+        # Захват непосредственно перед отправкой, чтобы срок захвата не уходил на ожидание лимитов
+        if not claim_report(report["id"]):
+            continue
+        try:
+            message, markup = render_report(report, report_counts[report.get("phone_number", "")])
+            deliver_report(report, message, markup)
+            if mark_as_sent(report["id"]):
+                release_photo(report.get("photo_unique_id"))
+        except Exception as e:
+            # Отчёт остаётся неотправленным и будет повторён после истечения захвата
+            print(f"Ошибка при обработке отчета: {e}")
+            failed += 1
+    return failed
 
 
 # ===================================================
@@ -454,6 +1531,7 @@ def send_reports():
 # ===================================================
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('return_'))
+@timed_handler
 def handle_return_decision(call):
     try:
         action, report_id, user_id = call.data.split('_')[1:]
@@ -528,14 +1606,18 @@ def handle_return_decision(call):
 # Этот процесс работает во втором потоке
 reporting_thread = threading.Thread(target=send_reports)
 reporting_thread.start()
+probe_state['dispatcher_thread'] = reporting_thread
 
 
 # ===============================================
 # =============== Ответ от админа ===============
 # ===============================================
 
+# Только чат с отчетами: ответы райдеров на вопросы бота в личном чате идут в шаги заявки
 @bot.message_handler(
-    func=lambda message: message.reply_to_message and message.reply_to_message.from_user.id == bot.get_me().id)
+    func=lambda message: message.chat.id == CHAT_ID and message.reply_to_message
+    and message.reply_to_message.from_user.id == get_bot_user().id)
+@timed_handler
 def handle_replied_message(message):
     try:
         user_id = message.from_user.id
@@ -827,28 +1909,70 @@ def update_return_status(report_id, status, user_id, refund_amount=None):
     except Exception as e:
         print(f"Ошибка при обновлении статуса возврата: {e}")
 
+# ===========================================
+# =============== Шаги заявки ===============
+# ===========================================
+
+# Текстовые ответы пользователя внутри заявки обрабатываются раньше кнопок меню
+def in_dialog_step(message):
+    # В чате с отчетами заявки не заполняются, хранилище не запрашиваем
+    if message.chat.id == CHAT_ID:
+        message.dialog = (None, {})
+        return False
+    state, _ = message_dialog(message)
+    return state in dialog_steps
+
+@bot.message_handler(func=in_dialog_step)
+def handle_dialog_step(message):
+    if message.text == "В главное меню":
+        back_to_menu(message)
+        return
+
+    state, data = message.dialog
+    step = dialog_steps[state]
+    with HANDLER_LATENCY.labels(step.__name__).time():
+        step(message, data)
+
+
+# ====================================================
+# =============== Маршруты кнопок меню ===============
+# ====================================================
+
+# Текст кнопки -> обработчик, заполняется декоратором menu_button при загрузке
+menu_routes = {}
+menu_handler_names = {}
+
+def menu_button(text):
+    def register(handler):
+        if text in menu_routes:
+            raise ValueError(f"Кнопка «{text}» уже обрабатывается функцией {menu_routes[text].__name__}")
+        if menu_handler_names.get(handler.__name__, handler) is not handler:
+            raise ValueError(f"Обработчик {handler.__name__} определён повторно")
+        menu_routes[text] = handler
+        menu_handler_names[handler.__name__] = handler
+        return handler
+    return register
+
+# Все кнопки меню обрабатываются одним поиском по словарю
+@bot.message_handler(func=lambda message: message.text in menu_routes)
+def handle_menu_button(message):
+    handler = menu_routes[message.text]
+    with HANDLER_LATENCY.labels(handler.__name__).time():
+        handler(message)
+
+
 # ============================================
 # =============== Главное меню ===============
 # ============================================
 
 # Обработка кнопки "В главное меню"
-@bot.message_handler(func=lambda message: message.text == "В главное меню")
+@menu_button("В главное меню")
 def back_to_menu(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    HelpWithMoneyButton = types.KeyboardButton("Как арендовать самокат❓")
-    WhereMyMoneyButton = types.KeyboardButton("Почему списалось 300₽❓")
-    CreateReportButton = types.KeyboardButton("Проблема с самокатом❓")
-    ProblemWithStopRent = types.KeyboardButton("Как завершить поездку❓")
-
-    markup.add(WhereMyMoneyButton, CreateReportButton)
-    markup.add(HelpWithMoneyButton, ProblemWithStopRent)
+    leave_dialog(message)
 
     bot.send_message(message.chat.id,
                      'Вы в главном меню чат поддержки «Akku-Batt», выберите в чем Вам нужно помочь?',
-                     reply_markup=markup)
+                     reply_markup=MAIN_MENU_KEYBOARD)
 
 
 # ==============================================
@@ -857,22 +1981,13 @@ def back_to_menu(message):
 
 # Обработка кнопки "/start"
 @bot.message_handler(commands=['start'])
+@timed_handler
 def start_message(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    HelpWithMoneyButton = types.KeyboardButton("Как арендовать самокат❓")
-    WhereMyMoneyButton = types.KeyboardButton("Почему списалось 300₽❓")
-    CreateReportButton = types.KeyboardButton("Проблема с самокатом❓")
-    ProblemWithStopRent = types.KeyboardButton("Как завершить поездку❓")
-
-    markup.add(WhereMyMoneyButton, CreateReportButton)
-    markup.add(HelpWithMoneyButton, ProblemWithStopRent)
+    leave_dialog(message)
 
     bot.send_message(message.chat.id,
                      'Здравствуйте, Вы написали в чат-бот поддержку «Akku-Batt». В чем Вам нужно помочь?',
-                     reply_markup=markup)
+                     reply_markup=MAIN_MENU_KEYBOARD)
 
 
 # ============================================
@@ -880,34 +1995,30 @@ def start_message(message):
 # ============================================
 
 # Обработка кнопки "Назад", которая отправляет в туториал по аренде
-@bot.message_handler(func=lambda message: message.text == "🔙 Назад")
+@menu_button("🔙 Назад")
 def back_to_rent_tutorial(message):
-    global flag
-    flag = False
+    leave_dialog(message)
 
     tutorial_how_rent_scooter(message)
 
 # Обработка кнопки "Назад", которая отправляет в туториал как остановить аренду
-@bot.message_handler(func=lambda message: message.text == "🔙 Нaзaд")
+@menu_button("🔙 Нaзaд")
 def back_to_stop_rent_tutorial(message):
-    global flag
-    flag = False
+    leave_dialog(message)
 
     problem_with_stop_rent(message)
 
 # Обработка кнопки "Назад", которая отправляет в туториал как установить приложение
-@bot.message_handler(func=lambda message: message.text == "🔙 Нaзад")
+@menu_button("🔙 Нaзад")
 def go_back_install_app(message):
-    global flag
-    flag = False
+    leave_dialog(message)
 
     how_to_install_app(message)
 
 # Обработка кнопки "Назад", которая отправляет в туториал как установить приложение
-@bot.message_handler(func=lambda message: message.text == "🔙 Haзaд")
+@menu_button("🔙 Haзaд")
 def go_back_install_to_problem(message):
-    global flag
-    flag = False
+    leave_dialog(message)
 
     problem_with_scooter(message)
 
@@ -915,318 +2026,187 @@ def go_back_install_to_problem(message):
 # =============== Почему списалось 300р ===============
 # =====================================================
 
-@bot.message_handler(func=lambda message: message.text == "Почему списалось 300₽❓")
+@menu_button("Почему списалось 300₽❓")
 def where_my_money_button(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    ReturnDidNotArrive = types.KeyboardButton("💸 Не пришёл возврат?")
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-
-    markup.add(ReturnDidNotArrive)
-    markup.add(BackToMainMenuButton)
+    leave_dialog(message)
 
     bot.send_message(message.chat.id, WhereMoneyText,
-                     reply_markup=markup)
+                     reply_markup=WHERE_MONEY_KEYBOARD)
 
 # ==================================================
 # =============== Не пришёл возврат? ===============
 # ==================================================
 
-@bot.message_handler(func=lambda message: message.text == "💸 Не пришёл возврат?")
+@menu_button("💸 Не пришёл возврат?")
 def return_did_not_arrive(message):
-    global flag
-    flag = False
+    leave_dialog(message)
 
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-
-    markup.add(BackToMainMenuButton)
-
-    bot.send_message(message.chat.id, ReturnDidNotArrivee, reply_markup=markup)
+    bot.send_message(message.chat.id, ReturnDidNotArrivee, reply_markup=BACK_TO_MENU_KEYBOARD)
 
 # ======================================================
 # =============== Как арендовать самокат ===============
 # ======================================================
 
-@bot.message_handler(func=lambda message: message.text == "Как арендовать самокат❓")
+@menu_button("Как арендовать самокат❓")
 def tutorial_how_rent_scooter(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    TutorialHowInstallAppButton = types.KeyboardButton("🛴 Как установить приложение?")
-    TutorialHowStartRentButton = types.KeyboardButton("🛴 Как арендовать самокат?")
-    WhereGreenZone = types.KeyboardButton("⚠️ Разрешенные зоны для катания")
-    TutorialHowRideButton = types.KeyboardButton("🛴 Как кататься?")
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
+    leave_dialog(message)
 
-    markup.add(TutorialHowInstallAppButton, TutorialHowStartRentButton)
-    markup.add(TutorialHowRideButton, WhereGreenZone)
-    markup.add(BackToMainMenuButton)
-
-    bot.send_message(message.chat.id, 'Выберите, что вас интересует:', reply_markup=markup)
+    bot.send_message(message.chat.id, 'Выберите, что вас интересует:', reply_markup=RENT_TUTORIAL_KEYBOARD)
 
 # ==========================================================
 # =============== Как установить приложение? ===============
 # ==========================================================
 
-@bot.message_handler(func=lambda message: message.text == "🛴 Как установить приложение?")
+@menu_button("🛴 Как установить приложение?")
 def how_to_install_app(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentTutorial = types.KeyboardButton("🔙 Назад")
-    markup.add(BackToRentTutorial, BackToMainMenuButton)
+    leave_dialog(message)
 
-    bot.send_message(message.chat.id, RegistrationTutorialText, reply_markup=markup)
+    bot.send_message(message.chat.id, RegistrationTutorialText, reply_markup=RENT_TUTORIAL_BACK_KEYBOARD)
 
 # ======================================================
 # =============== Как арендовать самокат ===============
 # ======================================================
 
-@bot.message_handler(func=lambda message: message.text == "🛴 Как арендовать самокат?")
+@menu_button("🛴 Как арендовать самокат?")
 def how_to_rent_scooter(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentMenuButton = types.KeyboardButton("🔙 Назад")
-    markup.add(BackToRentMenuButton, BackToMainMenuButton)
+    leave_dialog(message)
 
-    bot.send_message(message.chat.id, RentTutorialText, reply_markup=markup)
+    bot.send_message(message.chat.id, RentTutorialText, reply_markup=RENT_TUTORIAL_BACK_KEYBOARD)
 
 # =============================================
 # =============== Как кататься? ===============
 # =============================================
 
-@bot.message_handler(func=lambda message: message.text == "🛴 Как кататься?")
+@menu_button("🛴 Как кататься?")
 def how_to_ride_on_scooter(message):
-    global flag
-    flag = False
+    leave_dialog(message)
 
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentMenuButton = types.KeyboardButton("🔙 Назад")
-
-    markup.add(BackToRentMenuButton, BackToMainMenuButton)
-
-    bot.send_message(message.chat.id, HowToRideTutorialText, reply_markup=markup)
+    bot.send_message(message.chat.id, HowToRideTutorialText, reply_markup=RENT_TUTORIAL_BACK_KEYBOARD)
 
 # ================================================
 # =============== Разрешенные зоны ===============
 # ================================================
 
-@bot.message_handler(func=lambda message: message.text == "⚠️ Разрешенные зоны для катания")
+@menu_button("⚠️ Разрешенные зоны для катания")
 def where_you_can_ride(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentMenuButton = types.KeyboardButton("🔙 Назад")
-
-    markup.add(BackToMainMenuButton)
-    markup.add(BackToRentMenuButton)
+    leave_dialog(message)
 
     bot.send_message(
-        message.chat.id, WhereICanRide, reply_markup=markup)
+        message.chat.id, WhereICanRide, reply_markup=GREEN_ZONE_KEYBOARD)
 
 # =====================================================
 # =============== Как завершить поездку ===============
 # =====================================================
 
-@bot.message_handler(func=lambda message: message.text == "Как завершить поездку❓")
+@menu_button("Как завершить поездку❓")
 def problem_with_stop_rent(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    HowToEndRent = types.KeyboardButton("⚠️ Как завершить аренду?")
-    DontHaveButtonStopRent = types.KeyboardButton("⚠️ Нет кнопки завершить")
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
+    leave_dialog(message)
 
-    markup.add(HowToEndRent, DontHaveButtonStopRent)
-    markup.add(BackToMainMenuButton)
-
-    bot.send_message(message.chat.id,'Выберите, что вас интересует:', reply_markup=markup)
+    bot.send_message(message.chat.id,'Выберите, что вас интересует:', reply_markup=STOP_RENT_KEYBOARD)
 
 # ====================================================
 # =============== Нет кнопки завершить ===============
 # ====================================================
 
-@bot.message_handler(func=lambda message: message.text == "⚠️ Нет кнопки завершить")
-def how_to_end_rent(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentMenuButton = types.KeyboardButton("🔙 Нaзaд")
-
-    markup.add(BackToMainMenuButton)
-    markup.add(BackToRentMenuButton)
+@menu_button("⚠️ Нет кнопки завершить")
+def no_finish_button(message):
+    leave_dialog(message)
 
     bot.send_message(message.chat.id, FinishRentManualText,
-                     reply_markup=markup)
+                     reply_markup=STOP_RENT_BACK_KEYBOARD)
 
 # ====================================================
 # =============== Как завершить аренду ===============
 # ====================================================
 
-@bot.message_handler(func=lambda message: message.text == "⚠️ Как завершить аренду?")
+@menu_button("⚠️ Как завершить аренду?")
 def how_to_end_rent(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentMenuButton = types.KeyboardButton("🔙 Нaзaд")
-
-    markup.add(BackToMainMenuButton)
-    markup.add(BackToRentMenuButton)
+    leave_dialog(message)
 
     bot.send_message(message.chat.id, HowStopRentText,
-                     reply_markup=markup)
+                     reply_markup=STOP_RENT_BACK_KEYBOARD)
 
 
 # ==================================================
 # =============== Где можно кататься ===============
 # ==================================================
 
-@bot.message_handler(func=lambda message: message.text == "⚠️ Где можно кататься?")
-def where_you_can_ride(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentMenuButton = types.KeyboardButton("🔙 Нaзaд")
-
-    markup.add(BackToMainMenuButton)
-    markup.add(BackToRentMenuButton)
+@menu_button("⚠️ Где можно кататься?")
+def where_you_can_ride_from_stop_rent(message):
+    leave_dialog(message)
 
     bot.send_message(
-        message.chat.id, WhereICanRide, reply_markup=markup
+        message.chat.id, WhereICanRide, reply_markup=STOP_RENT_BACK_KEYBOARD
     )
 
 # ===================================================
 # =============== Не нашли что искали ===============
 # ===================================================
 
-@bot.message_handler(func=lambda message: message.text == "Не нашли что искали❓")
+@menu_button("Не нашли что искали❓")
 def did_not_find_the_researched(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    markup.add(BackToMainMenuButton)
+    leave_dialog(message)
 
     bot.send_message(message.chat.id, 'Если Вы не нашли нужный вам пункт, позвоните по номеру: +7(926)013-43-85',
-                     reply_markup=markup)
+                     reply_markup=BACK_TO_MENU_KEYBOARD)
 
 # ==================================================
 # =============== Где можнo кататься ===============
 # ==================================================
 
 # Обработка кнопки "Где можно кататься?"
-@bot.message_handler(func=lambda message: message.text == "⚠️ Где можнo кататься?")
-def where_you_can_ride(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentMenuButton = types.KeyboardButton("🔙 Haзaд")
-
-    markup.add(BackToMainMenuButton)
-    markup.add(BackToRentMenuButton)
+@menu_button("⚠️ Где можнo кататься?")
+def where_you_can_ride_from_problem(message):
+    leave_dialog(message)
 
     bot.send_message(
-        message.chat.id, WhereICanRide, reply_markup=markup
+        message.chat.id, WhereICanRide, reply_markup=PROBLEM_BACK_KEYBOARD
     )
 
 # ======================================================
 # =============== Самoкат перестал ехать ===============
 # ======================================================
 
-@bot.message_handler(func=lambda message: message.text == "⚠️ Самoкат перестал ехать")
+@menu_button("⚠️ Самoкат перестал ехать")
 def scooter_not_goes(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentMenuButton = types.KeyboardButton("🔙 Haзaд")
-
-    markup.add(BackToMainMenuButton)
-    markup.add(BackToRentMenuButton)
+    leave_dialog(message)
 
     bot.send_message(message.chat.id, ScooterDontWork,
-                     reply_markup=markup)
+                     reply_markup=PROBLEM_BACK_KEYBOARD)
 
 # =====================================================
 # =============== Cамокат едет медленно ===============
 # =====================================================
 
-@bot.message_handler(func=lambda message: message.text == "🛴 Cамокат едет медленно?")
+@menu_button("🛴 Cамокат едет медленно?")
 def why_scooter_so_slowly(message):
-    global flag
-    flag = False
+    leave_dialog(message)
 
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    BackToRentMenuButton = types.KeyboardButton("🔙 Haзaд")
-
-    markup.add(BackToRentMenuButton, BackToMainMenuButton)
-
-    bot.send_message(message.chat.id, ScooterControlsText, reply_markup=markup)
+    bot.send_message(message.chat.id, ScooterControlsText, reply_markup=SCOOTER_CONTROLS_KEYBOARD)
 
 # ====================================================
 # =============== Проблема с самокатом ===============
 # ====================================================
 
-@bot.message_handler(func=lambda message: message.text == "Проблема с самокатом❓")
+@menu_button("Проблема с самокатом❓")
 def problem_with_scooter(message):
-    global flag
-    flag = False
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    ScooterNotGoes = types.KeyboardButton("⚠️ Самoкат перестал ехать")
-    ScooterIsSoSlowly = types.KeyboardButton("🛴 Cамокат едет медленно?")
-    INeedReturn = types.KeyboardButton("Нужен возврат❓")
-    DidNotFindTheSearched = types.KeyboardButton("Не нашли что искали❓")
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-
-    markup.add(INeedReturn, ScooterNotGoes)
-    markup.add(ScooterIsSoSlowly, DidNotFindTheSearched)
-    markup.add(BackToMainMenuButton)
+    leave_dialog(message)
 
-    bot.send_message(message.chat.id, 'Выберите, что вас интересует:', reply_markup=markup)
+    bot.send_message(message.chat.id, 'Выберите, что вас интересует:', reply_markup=PROBLEM_KEYBOARD)
 
 # =============================================
 # =============== Нужен возврат ===============
 # =============================================
 
-@bot.message_handler(func=lambda message: message.text == "Нужен возврат❓")
+@menu_button("Нужен возврат❓")
 def report(message):
-    global flag, photo_process_flag
-    flag = True
-    photo_process_flag = True
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    BackToMainMenuButton = types.KeyboardButton("В главное меню")
-    markup.add(BackToMainMenuButton)
+    set_dialog(message.chat.id, 'photo')
+    REFUND_FUNNEL.labels('started').inc()
 
     bot.send_message(message.chat.id,
                      "Для оформления заявки на возврат средств потребуется предоставить дополнительные данные. \n\n"
                      "Пожалуйста, прикрепите одну фотографию вашего самоката.",
-                     reply_markup=markup)
+                     reply_markup=BACK_TO_MENU_KEYBOARD)
 
 
 # =======================================================
@@ -1234,9 +2214,11 @@ def report(message):
 # =======================================================
 
 @bot.message_handler(content_types=['photo', 'video'])
+@timed_handler
 def handle_media(message):
-    global flag, photo_process_flag, processed_media_groups
-    if not flag:
+    global processed_media_groups
+    state, data = message_dialog(message)
+    if state != 'photo':
         return
 
     if message.media_group_id is not None:
@@ -1253,166 +2235,69 @@ def handle_media(message):
         return
 
     try:
-        # Обработка одиночного фото
-        photo_file = bot.get_file(message.photo[-1].file_id)
-        photo_path = os.path.join(PHOTOS_DIR, f"{photo_file.file_id}.jpg")
-
-        downloaded_file = bot.download_file(photo_file.file_path)
-        with open(photo_path, 'wb') as new_file:
-            new_file.write(downloaded_file)
-
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add(types.KeyboardButton("В главное меню"))
-
+        # Обработка одиночного фото: в заявке достаточно file_id, фото уже лежит на серверах Telegram.
+        # Копия для архива скачивается в фоне и привязывается к заявке позже
+        photo_size = message.photo[-1]
+        if ARCHIVE_PHOTOS:
+            enqueue_photo(photo_size)
+
+        set_dialog(message.chat.id, 'rental_time', {
+            'photo_path': "",
+            'photo_file_id': photo_size.file_id,
+            'photo_unique_id': photo_size.file_unique_id
+        })
+        REFUND_FUNNEL.labels('photo').inc()
         bot.send_message(message.chat.id, "Укажите пожалуйста время начала аренды (ДД.ММ ЧЧ:ММ)",
-                         reply_markup=markup)
-        bot.register_next_step_handler(message, process_rental_time, photo_path)
-
-        photo_process_flag = False
+                         reply_markup=BACK_TO_MENU_KEYBOARD)
 
     except Exception as e:
         bot.send_message(message.chat.id, f"Произошла ошибка при обработке фото: {str(e)}")
 
-# =======================================================
-# =============== Валидация данных (Дата) ===============
-# =======================================================
-
-def validate_correct_rental_time(rental_time):
-    try:
-        datetime.strptime(rental_time, "%d.%m %H:%M")
-        return True
-    except ValueError:
-        return False
-
-# =======================================================
-# =============== Валидация данных (Дата) ===============
-# =======================================================
-
-def validate_rental_time(rental_time):
-    try:
-        rental_datetime = datetime.strptime(rental_time, "%d.%m %H:%M")
-        now_time = datetime.now()
-        rental_datetime = rental_datetime.replace(year=now_time.year)
-
-        if rental_datetime < now_time - timedelta(days=30):
-            return False
-
-        return True
-    except ValueError:
-        return False
-
 # ========================================================
 # =============== Получение даты и времени ===============
 # ========================================================
 
-def process_rental_time(message, photo_path):
-    if message.text == "В главное меню":
-        back_to_menu(message)
-        return
+RENTAL_TIME_ERRORS = {
+    'format': "Некорректный формат времени. Пожалуйста, введите время в формате: ДД.ММ ЧЧ:ММ",
+    'range': "Дата вашей аренды должна быть не раньше текущего времени и не позднее чем через 30 дней.\n"
+             "Пожалуйста, введите время в формате: ДД.ММ ЧЧ:ММ",
+}
 
-    rental_time = message.text.strip()
+def process_rental_time(message, data):
+    rental_time = validate_rental_time(message.text)
 
-    if not validate_correct_rental_time(rental_time):
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add(types.KeyboardButton("В главное меню"))
-        bot.send_message(message.chat.id,
-                         "Некорректный формат времени. Пожалуйста, введите время в формате: ДД.ММ ЧЧ:ММ",
-                         reply_markup=markup)
-        bot.register_next_step_handler(message, process_rental_time, photo_path)
+    if not rental_time.ok:
+        bot.send_message(message.chat.id, RENTAL_TIME_ERRORS[rental_time.error], reply_markup=BACK_TO_MENU_KEYBOARD)
         return
 
-    elif not validate_rental_time(rental_time):
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add(types.KeyboardButton("В главное меню"))
-        bot.send_message(message.chat.id,
-                         "Дата вашей аренды должна быть не раньше текущего времени и не позднее чем через 30 дней.\n"
-                         "Пожалуйста, введите время в формате: ДД.ММ ЧЧ:ММ",
-                         reply_markup=markup)
-        bot.register_next_step_handler(message, process_rental_time, photo_path)
-        return
-
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add(types.KeyboardButton("В главное меню"))
-
-    bot.send_message(message.chat.id, "Укажите, пожалуйста, номер Вашего самоката", reply_markup=markup)
-    bot.register_next_step_handler(message, process_scooter_number, rental_time, photo_path)
+    data['rental_time'] = rental_time.value
+    set_dialog(message.chat.id, 'scooter_number', data)
+    REFUND_FUNNEL.labels('rental_time').inc()
+    bot.send_message(message.chat.id, "Укажите, пожалуйста, номер Вашего самоката", reply_markup=BACK_TO_MENU_KEYBOARD)
 
 # =========================================================
 # =============== Получение номера самоката ===============
 # =========================================================
 
-def process_scooter_number(message, rental_time, photo_path):
-    if message.text == "В главное меню":
-        back_to_menu(message)
-        return
+SCOOTER_NUMBER_ERRORS = {
+    'digits': "Введите числовой номер самоката, длиной в 4 цифры. Пожалуйста, укажите номер снова.",
+    'length': "Номер самоката должен содержать ровно 4 цифры. Пожалуйста, укажите номер снова.",
+}
 
-    scooter_number = message.text
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add(types.KeyboardButton("В главное меню"))
-
-    # Проверка, что номер состоит только из цифр
-    if not scooter_number.isdigit():
-        bot.send_message(message.chat.id,
-                         "Введите числовой номер самоката, длиной в 4 цифры. Пожалуйста, укажите номер снова.",
-                         reply_markup=markup)
-        bot.register_next_step_handler(message, process_scooter_number, rental_time, photo_path)
-        return
+def process_scooter_number(message, data):
+    scooter_number = validate_digits(message.text)
 
-    # Проверка длины номера
-    if len(scooter_number) != 4:
-        bot.send_message(message.chat.id,
-                         "Номер самоката должен содержать ровно 4 цифры. Пожалуйста, укажите номер снова.",
-                         reply_markup=markup)
-        bot.register_next_step_handler(message, process_scooter_number, rental_time, photo_path)
+    if not scooter_number.ok:
+        bot.send_message(message.chat.id, SCOOTER_NUMBER_ERRORS[scooter_number.error],
+                         reply_markup=BACK_TO_MENU_KEYBOARD)
         return
 
     # Если проверки пройдены, запрашиваем номер телефона
+    data['scooter_number'] = scooter_number.value
+    set_dialog(message.chat.id, 'phone_number', data)
+    REFUND_FUNNEL.labels('scooter_number').inc()
     bot.send_message(message.chat.id, "Укажите пожалуйста Ваш номер телефона",
-                     reply_markup=markup)
-    bot.register_next_step_handler(message, process_phone_number, scooter_number, rental_time, photo_path)
-
-
-# ==========================================================
-# =============== Валидация данных (Телефон) ===============
-# ==========================================================
-
-def format_phone_number(phone_number):
-    phone_number = phone_number.strip()
-
-    digits = ''.join(c for c in phone_number if c.isdigit())
-
-    if len(digits) == 11:
-        if digits.startswith('7'):
-            return '+' + digits
-        elif digits.startswith('8'):
-            return '+7' + digits[1:]
-    elif len(digits) == 10:
-        return '+7' + digits
-
-    return None
-
-# ==========================================================
-# =============== Валидация данных (Телефон) ===============
-# ==========================================================
-
-def is_valid_russian_phone_number(phone_number):
-    phone_number = phone_number.strip()
-
-    if phone_number.startswith('+7'):
-        if len(phone_number) != 12:
-            return False
-    elif phone_number.startswith(('7', '8')):
-        if len(phone_number) != 11:
-            return False
-    else:
-        return False
-
-    # Проверяем, что остальные символы - цифры
-    digits = phone_number[1:] if phone_number.startswith('+') else phone_number
-    if not digits.isdigit():
-        return False
-
-    return True
+                     reply_markup=BACK_TO_MENU_KEYBOARD)
 
 
 # =========================================================
@@ -1420,128 +2305,107 @@ def is_valid_russian_phone_number(phone_number):
 # =========================================================
 
 # Получение номера телефона
-def process_phone_number(message, scooter_number, rental_time, photo_path):
-    if message.text == "В главное меню":
-        back_to_menu(message)
-        return
-
-    phone_number = message.text.strip()
-
-    if not is_valid_russian_phone_number(phone_number):
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        button_back_to_menu = types.KeyboardButton("В главное меню")
-        markup.add(button_back_to_menu)
+def process_phone_number(message, data):
+    # Проверка и приведение к формату +7XXXXXXXXXX за один разбор
+    phone_number = validate_phone_number(message.text)
 
+    if not phone_number.ok:
         bot.send_message(message.chat.id, "Некорректный номер телефона. "
                                           "Пожалуйста, введите номер в формате: +7XXX..., 7XXX... или 8XXX...",
-                         reply_markup=markup)
-        bot.register_next_step_handler(message, process_phone_number, scooter_number, rental_time, photo_path)
+                         reply_markup=BACK_TO_MENU_KEYBOARD)
         return
 
-    # Форматируем номер
-    formatted_number = format_phone_number(phone_number)
-    if not formatted_number:
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        button_back_to_menu = types.KeyboardButton("В главное меню")
-        markup.add(button_back_to_menu)
+    formatted_number = phone_number.value
 
-        bot.send_message(message.chat.id, "Ошибка форматирования номера. "
-                                          "Пожалуйста, введите номер в формате: +7XXX..., 7XXX... или 8XXX...",
-                         reply_markup=markup)
-        bot.register_next_step_handler(message, process_phone_number, scooter_number, rental_time, photo_path)
+    if refund_limit_reached(formatted_number):
+        FLOOD_DROPPED.labels('refund').inc()
+        reset_dialog(message.chat.id)
+        bot.send_message(message.chat.id, "С этого номера уже отправлено несколько заявок. "
+                                          "Мы рассмотрим их и свяжемся с Вами.", reply_markup=BACK_TO_MENU_KEYBOARD)
         return
 
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    button_back_to_menu = types.KeyboardButton("В главное меню")
-    markup.add(button_back_to_menu)
-
+    data['phone_number'] = formatted_number
+    set_dialog(message.chat.id, 'card_number', data)
+    REFUND_FUNNEL.labels('phone_number').inc()
     bot.send_message(message.chat.id, "Укажите пожалуйста последние 4 цифры Вашей карты, которая "
-                                      "привязана к профилю Akku-Batt.", reply_markup=markup)
-    bot.register_next_step_handler(message, process_card_number, scooter_number, formatted_number,
-                                   rental_time, photo_path)
+                                      "привязана к профилю Akku-Batt.", reply_markup=BACK_TO_MENU_KEYBOARD)
 
 
 # ======================================================
 # =============== Получение номера карты ===============
 # ======================================================
 
-def process_card_number(message, scooter_number, phone_number, rental_time, photo_path):
-    if message.text == "В главное меню":
-        back_to_menu(message)
-        return
+CARD_NUMBER_ERRORS = {
+    'digits': "Введите числовой номер карты, последние 4 цифры. Пожалуйста, укажите номер снова.",
+    'length': "Номер карты должен содержать ровно 4 цифры. Пожалуйста, укажите номер снова.",
+}
 
-    card_number = message.text
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add(types.KeyboardButton("В главное меню"))
-
-    # Проверка, что номер состоит только из цифр
-    if not card_number.isdigit():
-        bot.send_message(message.chat.id,
-                         "Введите числовой номер карты, последние 4 цифры. Пожалуйста, укажите номер снова.",
-                         reply_markup=markup)
-        bot.register_next_step_handler(message, process_card_number,
-                                       scooter_number, phone_number, rental_time, photo_path)
-        return
+def process_card_number(message, data):
+    card_number = validate_digits(message.text)
 
-    # Проверка длины номера
-    if len(card_number) != 4:
-        bot.send_message(message.chat.id,
-                         "Номер карты должен содержать ровно 4 цифры. Пожалуйста, укажите номер снова.",
-                         reply_markup=markup)
-        bot.register_next_step_handler(message, process_card_number,
-                                       scooter_number, phone_number, rental_time, photo_path)
+    if not card_number.ok:
+        bot.send_message(message.chat.id, CARD_NUMBER_ERRORS[card_number.error], reply_markup=BACK_TO_MENU_KEYBOARD)
         return
 
     # Если проверки пройдены, запрашиваем описание проблемы
+    data['card_number'] = card_number.value
+    set_dialog(message.chat.id, 'description', data)
+    REFUND_FUNNEL.labels('card_number').inc()
     bot.send_message(message.chat.id,
                      "Опишите пожалуйста Вашу проблему",
-                     reply_markup=markup)
-    bot.register_next_step_handler(message, process_description,
-                                   scooter_number, phone_number, card_number,
-                                   rental_time, photo_path)
+                     reply_markup=BACK_TO_MENU_KEYBOARD)
 
 
 # ===========================================================
 # =============== Получение описания проблемы ===============
 # ===========================================================
 
-def process_description(message, scooter_number, phone_number, card_number, rental_time, photo_path):
-    if message.text == "В главное меню":
-        back_to_menu(message)
-        return
-
+def process_description(message, data):
     description = message.text
     user_id = message.from_user.id
 
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    button_back_to_menu = types.KeyboardButton("В главное меню")
-    markup.add(button_back_to_menu)
-
     try:
-        save_report(photo_path, scooter_number, phone_number, card_number, rental_time, description, user_id)
+        save_report(data['photo_path'], data['scooter_number'], data['phone_number'], data['card_number'],
+                    data['rental_time'], description, user_id,
+                    data.get('photo_unique_id'), data.get('photo_file_id'))
+        reset_dialog(message.chat.id)
+        REFUND_FUNNEL.labels('description').inc()
 
         bot.send_message(message.chat.id, "Спасибо за Ваше обращение, мы приняли его в обработку.\n\n"
                                           "Рассмотрение заявки пройдет в течении трёх рабочих дней. "
                                           "Для уточнения информации, с вами могут связаться наши сотрудники.\n\n"
                                           "Вы можете оставить самокат и поискать новый поблизости.",
-                         reply_markup=markup)
+                         reply_markup=BACK_TO_MENU_KEYBOARD)
     except Exception as e:
         print(f"Ошибка при сохранении отчета: {e}")
-        bot.send_message(message.chat.id, "Не удалось отправить заявку, заполните снова", reply_markup=markup)
+        bot.send_message(message.chat.id, "Не удалось отправить заявку, заполните снова", reply_markup=BACK_TO_MENU_KEYBOARD)
+
+
+# Обработчики шагов заявки по состоянию диалога
+dialog_steps = {
+    'rental_time': process_rental_time,
+    'scooter_number': process_scooter_number,
+    'phone_number': process_phone_number,
+    'card_number': process_card_number,
+    'description': process_description,
+}
 
 
 # ========================================================
 # =============== Сохранение в базу данных ===============
 # ========================================================
 
-def save_report(photo, scooter_number, phone_number, card_number, rental_time, description, user_id):
+def save_report(photo, scooter_number, phone_number, card_number, rental_time, description, user_id,
+                photo_unique_id=None, photo_file_id=None):
     try:
-        report_id = get_next_sequence_value("reportid")
+        report_id = allocate_id("reportid")
 
         db.reports.insert_one({
             "id": report_id,
             "user_id": int(user_id),
             "photo": photo,
+            "photo_unique_id": photo_unique_id,
+            "photo_file_id": photo_file_id,
             "rental_time": rental_time,
             "scooter_number": scooter_number,
             "phone_number": phone_number,
@@ -1551,6 +2415,11 @@ def save_report(photo, scooter_number, phone_number, card_number, rental_time, d
             "returned": 0,
             "created_at": datetime.now()
         })
+        acquire_photo(photo_unique_id)
+        if ARCHIVE_PHOTOS and photo_unique_id and not photo:
+            # Фото могло скачаться, пока пользователь заполнял заявку
+            link_stored_photo(photo_unique_id)
+        notify_new_report()
     except Exception as e:
         raise e
 
@@ -1560,12 +2429,14 @@ def save_report(photo, scooter_number, phone_number, card_number, rental_time, d
 # ===========================================================
 
 @bot.message_handler(func=lambda message: True)
+@timed_handler
 def handle_unknown_message(message):
     # Игнорируем сообщения не в ответ в чате с отчетами
-    if message.chat.id == int(CHAT_ID) and not message.reply_to_message:
+    if message.chat.id == CHAT_ID and not message.reply_to_message:
         return
 
-    if flag == False and photo_process_flag == False:
+    state, _ = message_dialog(message)
+    if state is None:
         if message.text not in ["Как арендовать самокат❓",
                                 "Почему списалось 300₽❓",
                                 "Проблема с самокатом❓",
@@ -1581,6 +2452,10 @@ def handle_unknown_message(message):
 
 if __name__ == '__main__':
     print("Бот запущен...")
-    bot.remove_webhook()
-    time.sleep(1)
-    bot.infinity_polling()
+    get_bot_user()
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        bot.remove_webhook()
+        time.sleep(1)
+        bot.infinity_polling()
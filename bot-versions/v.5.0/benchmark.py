@@ -0,0 +1,237 @@
+# ================================================
+# =============== НАГРУЗОЧНЫЙ ТЕСТ ===============
+# ================================================
+
+# Прогоняет бота v5.0 через локальную заглушку Bot API (fake_telegram.py) без выхода в сеть.
+# Каждый райдер проходит заявку на возврат от кнопки «Нужен возврат❓» до описания проблемы,
+# затем администратор одобряет или отклоняет его отчёт кнопками под сообщением.
+#
+# Запуск с локальной MongoDB (база DATABASE_NAME очищается перед прогоном):
+#   python benchmark.py --riders 50 --concurrency 10
+# Запуск с MongoDB в памяти (нужен пакет mongomock):
+#   python benchmark.py --riders 50 --mongo memory
+#
+# Отчёт: p50/p99 задержки ответа бота по шагам, сообщений в секунду и время разбора очереди отчётов.
+# Каждое изменение производительности проверяется сравнением отчётов до и после.
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import fake_telegram
+from fake_telegram import fake, make_callback_update, make_photo_update, make_text_update
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AkkuBatt-Bot.v.5.0.py")
+ADMIN_CHAT_ID = -100500
+ADMIN_ID_OFFSET = 10_000_000  # id администраторов не пересекаются с id райдеров
+SEND_METHODS = {"sendMessage", "sendPhoto", "editMessageText", "editMessageCaption", "deleteMessage",
+                "answerCallbackQuery"}
+
+# ===========================================
+# =============== Запуск бота ===============
+# ===========================================
+
+def load_bot(args):
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123456:benchmark',
+        'TELEGRAM_CHAT_ID': str(ADMIN_CHAT_ID),
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{args.port}',
+        'MONGODB_URI': args.mongo_uri,
+        'DATABASE_NAME': args.database,
+        'STATE_STORAGE': args.state_storage,
+        'STATE_DB_PATH': os.path.join(args.work_dir, 'DialogStates.db'),
+        'PHOTOS_DIR': os.path.join(args.work_dir, 'photos'),
+        'ARCHIVE_PHOTOS': '1' if args.archive_photos else '0',
+        'BOT_MODE': 'polling',
+    })
+    if args.chat_rate:
+        os.environ['TELEGRAM_CHAT_RATE'] = str(args.chat_rate)
+
+    if args.mongo == 'memory':
+        import mongomock
+        import pymongo
+        # Бот импортирует MongoClient из pymongo, поэтому подменяем его до загрузки модуля
+        pymongo.MongoClient = mongomock.MongoClient
+    else:
+        from pymongo import MongoClient
+        MongoClient(args.mongo_uri).drop_database(args.database)
+
+    spec = importlib.util.spec_from_file_location("akkubatt_bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    threading.Thread(target=module.bot.infinity_polling,
+                     kwargs={"timeout": 5, "long_polling_timeout": 1}, daemon=True).start()
+    return module
+
+# ================================================
+# =============== Сценарий райдера ===============
+# ================================================
+
+timings = defaultdict(list)
+timings_lock = threading.Lock()
+
+def record(step, seconds):
+    with timings_lock:
+        timings[step].append(seconds)
+
+def chat_of(call):
+    return str(call[1].get("chat_id"))
+
+def sent_to(chat_id):
+    return lambda call: call[0] in ("sendMessage", "sendPhoto") and chat_of(call) == str(chat_id)
+
+# Новые версии pyTelegramBotAPI передают reply_parameters вместо reply_to_message_id
+def reply_target(call):
+    reply_parameters = call[1].get("reply_parameters")
+    if reply_parameters:
+        if isinstance(reply_parameters, str):
+            reply_parameters = json.loads(reply_parameters)
+        return reply_parameters.get("message_id")
+    return call[1].get("reply_to_message_id")
+
+def replied_to(message_id):
+    return lambda call: (call[0] == "sendMessage" and chat_of(call) == str(ADMIN_CHAT_ID)
+                         and str(reply_target(call)) == str(message_id))
+
+def callback_data(call):
+    markup = call[1].get("reply_markup") or "{}"
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    return [button.get("callback_data", "") for row in markup.get("inline_keyboard", []) for button in row]
+
+def report_for(user_id):
+    def match(call):
+        return (sent_to(ADMIN_CHAT_ID)(call)
+                and any(data.endswith(f"_{user_id}") for data in callback_data(call)))
+    return match
+
+# Отправляет обновление боту и ждёт его ответ; возвращает (номер вызова, вызов)
+def send_and_wait(step, update, match, timeout):
+    start_index = fake.call_count()
+    started = time.time()
+    fake.enqueue_update(update)
+    index, call = fake.wait_for(match, start_index, timeout)
+    record(step, call[3] - started)
+    return index, call
+
+RIDER_STEPS = [
+    ("report", lambda uid: make_text_update(uid, "Нужен возврат❓")),
+    ("photo", lambda uid: make_photo_update(uid, f"photo{uid}")),
+    ("rental_time", lambda uid: make_text_update(uid, datetime.now().strftime("%d.%m %H:%M"))),
+    ("scooter_number", lambda uid: make_text_update(uid, "1234")),
+    ("phone_number", lambda uid: make_text_update(uid, f"+7999{uid % 10_000_000:07d}")),
+    ("card_number", lambda uid: make_text_update(uid, "4242")),
+    ("description", lambda uid: make_text_update(uid, "Не завершается поездка")),
+]
+
+def run_rider(uid, args):
+    for step, make_update in RIDER_STEPS:
+        step_start = fake.call_count()
+        _, call = send_and_wait(step, make_update(uid), sent_to(uid), args.timeout)
+    acknowledged = call[3]
+
+    # Отчёт уходит администраторам из потока отправки и может опередить ответ райдеру,
+    # поэтому ищем его с начала последнего шага
+    _, report_call = fake.wait_for(report_for(uid), step_start, args.timeout)
+    delivered = report_call[3]
+    record("dispatch", max(delivered - acknowledged, 0))
+
+    if not args.no_admin:
+        decide(uid, report_call, approve=uid % 2 == 0, timeout=args.timeout)
+    return acknowledged, delivered
+
+# Администратор нажимает кнопку под отчётом и отвечает на вопросы бота
+def decide(uid, report_call, approve, timeout):
+    admin_id = ADMIN_ID_OFFSET + uid
+    report_message = report_call[2]
+    report_message_id = report_message["message_id"]
+    action = "return_approve_" if approve else "return_reject_"
+    data = next(data for data in callback_data(report_call) if data.startswith(action))
+
+    _, prompt = send_and_wait("admin_decision", make_callback_update(admin_id, report_message, data),
+                              replied_to(report_message_id), timeout)
+    if approve:
+        _, prompt = send_and_wait("admin_amount", make_text_update(admin_id, "150", ADMIN_CHAT_ID, prompt[2]),
+                                  replied_to(report_message_id), timeout)
+        send_and_wait("admin_comment", make_text_update(admin_id, "-", ADMIN_CHAT_ID, prompt[2]),
+                      sent_to(uid), timeout)
+    else:
+        send_and_wait("admin_reason", make_text_update(admin_id, "Нарушений не найдено", ADMIN_CHAT_ID, prompt[2]),
+                      sent_to(uid), timeout)
+
+# =====================================
+# =============== Отчёт ===============
+# =====================================
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def print_report(results, failures, elapsed):
+    print(f"\n{'Шаг':<16}{'N':>7}{'p50, мс':>12}{'p99, мс':>12}")
+    for step in [name for name, _ in RIDER_STEPS] + ["dispatch", "admin_decision", "admin_amount",
+                                                     "admin_comment", "admin_reason"]:
+        values = timings.get(step)
+        if values:
+            print(f"{step:<16}{len(values):>7}{percentile(values, 0.5) * 1000:>12.1f}"
+                  f"{percentile(values, 0.99) * 1000:>12.1f}")
+
+    sent = sum(1 for call in fake.sent() if call[0] in SEND_METHODS)
+    updates = sum(len(values) for step, values in timings.items() if step != "dispatch")
+    print(f"\nРайдеров: {len(results)} успешно, {failures} с ошибкой, время прогона {elapsed:.1f} с")
+    print(f"Обновлений в секунду: {updates / elapsed:.1f}")
+    print(f"Сообщений бота в секунду: {sent / elapsed:.1f}")
+    if results:
+        # От последней принятой заявки до доставки последнего отчёта администраторам
+        drain = max(delivered for _, delivered in results) - max(acknowledged for acknowledged, _ in results)
+        print(f"Разбор очереди отчётов: {max(drain, 0):.2f} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальной заглушке Bot API")
+    parser.add_argument("--riders", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--mongo", choices=["local", "memory"], default="local")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="AkkuBattBenchmark")
+    parser.add_argument("--state-storage", choices=["mongo", "sqlite", "memory"], default="mongo")
+    parser.add_argument("--archive-photos", action="store_true", help="скачивать фото через getFile")
+    parser.add_argument("--chat-rate", type=float, help="TELEGRAM_CHAT_RATE для бота, сообщений в минуту")
+    parser.add_argument("--no-admin", action="store_true", help="не отвечать на отчёты")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+    args.work_dir = tempfile.mkdtemp(prefix="akkubatt-benchmark-")
+
+    fake_telegram.start(args.port)
+    load_bot(args)
+
+    results = []
+    failures = 0
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_rider, uid, args) for uid in range(1, args.riders + 1)]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                failures += 1
+                print(f"Ошибка райдера: {e!r}")
+    print_report(results, failures, time.time() - started)
+
+    # Flask, планировщик и поток отправки бота не останавливаются сами
+    sys.stdout.flush()
+    os._exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# ===========================================================
+# =============== ЛОКАЛЬНЫЙ FAKE TELEGRAM API ===============
+# ===========================================================
+
+# Заглушка Bot API для офлайн-проверки бота.
+#
+# Запуск сервера:
+#   python fake_telegram.py serve --port 8081
+# Бот запускается с TELEGRAM_API_URL=http://localhost:8081
+#
+# Отправка сообщения пользователя в веб-хук бота:
+#   python fake_telegram.py send --webhook http://localhost:5000/webhook --secret <WEBHOOK_SECRET> --text "/start"
+#
+# В режиме polling обновления кладутся в очередь fake.enqueue_update() и отдаются боту через getUpdates
+# (так работает benchmark.py).
+
+import argparse
+import itertools
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "AkkuBatt", "username": "akkubatt_bot"}
+
+# =================================================
+# =============== Состояние сервера ===============
+# =================================================
+
+class FakeTelegram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.message_ids = itertools.count(1)
+        self.calls = []  # (метод, параметры, результат, время)
+        self.updates = []  # очередь для getUpdates
+
+    def record(self, method, params, result):
+        with self.lock:
+            self.calls.append((method, params, result, time.time()))
+            self.changed.notify_all()
+
+    def sent(self, method=None):
+        with self.lock:
+            return [call for call in self.calls if method is None or call[0] == method]
+
+    # Ждёт вызов, подходящий под match, начиная с номера start; возвращает (номер, вызов)
+    def wait_for(self, match, start=0, timeout=30):
+        deadline = time.time() + timeout
+        with self.lock:
+            index = start
+            while True:
+                while index < len(self.calls):
+                    if match(self.calls[index]):
+                        return index, self.calls[index]
+                    index += 1
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("Бот не ответил за отведённое время")
+                self.changed.wait(remaining)
+
+    def call_count(self):
+        with self.lock:
+            return len(self.calls)
+
+    def enqueue_update(self, update):
+        with self.lock:
+            self.updates.append(update)
+            self.changed.notify_all()
+
+    def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        # Длинный опрос ограничен секундой, чтобы бот быстро замечал остановку
+        deadline = time.time() + min(float(params.get("timeout") or 0), 1.0)
+        with self.lock:
+            while True:
+                self.updates = [update for update in self.updates if update["update_id"] >= offset]
+                remaining = deadline - time.time()
+                if self.updates or remaining <= 0:
+                    return self.updates[:limit]
+                self.changed.wait(remaining)
+
+    def make_message(self, params, **extra):
+        message = {
+            "message_id": next(self.message_ids),
+            "from": BOT_USER,
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "date": int(time.time()),
+        }
+        message.update(extra)
+        return message
+
+    # Ответ на вызов метода Bot API
+    def call(self, method, params):
+        # getUpdates не записывается, иначе журнал заполнится пустыми опросами
+        if method == "getUpdates":
+            return self.get_updates(params)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "sendMessage":
+            result = self.make_message(params, text=params.get("text", ""))
+        elif method == "sendPhoto":
+            file_id = params.get("photo") if isinstance(params.get("photo"), str) else "uploaded"
+            result = self.make_message(params, caption=params.get("caption", ""), photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960}
+            ])
+        elif method == "getFile":
+            file_id = params.get("file_id", "")
+            result = {"file_id": file_id, "file_unique_id": file_id,
+                      "file_size": len(photo_bytes(file_id)), "file_path": f"photos/{file_id}.jpg"}
+        elif method == "editMessageText":
+            result = self.make_message(params, message_id=int(params.get("message_id", 0)),
+                                       text=params.get("text", ""))
+        elif method == "editMessageCaption":
+            result = self.make_message(params, message_id=int(params.get("message_id", 0)),
+                                       caption=params.get("caption", ""))
+        else:
+            result = True
+
+        self.record(method, params, result)
+        return result
+
+
+# Содержимое фото отличается для разных file_id, чтобы они не склеивались по хешу
+def photo_bytes(file_id):
+    return b"\xff\xd8\xff\xe0" + f"fake-photo:{file_id}".encode() + b"\xff\xd9"
+
+
+fake = FakeTelegram()
+
+# ===========================================
+# =============== HTTP-сервер ===============
+# ===========================================
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    def read_params(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json") and body:
+            params.update(json.loads(body))
+        elif content_type.startswith("application/x-www-form-urlencoded") and body:
+            params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+        elif content_type.startswith("multipart/form-data") and body:
+            # Загруженные файлы не разбираем, запоминаем только факт загрузки
+            params["upload_size"] = len(body)
+        return url.path, params
+
+    def reply(self, status, payload, content_type="application/json"):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self):
+        path, params = self.read_params()
+        parts = path.strip("/").split("/")
+
+        # Скачивание файла: /file/bot<token>/photos/<file_id>.jpg
+        if len(parts) == 4 and parts[0] == "file" and parts[1].startswith("bot"):
+            file_id = parts[3].rsplit(".", 1)[0]
+            self.reply(200, photo_bytes(file_id), content_type="image/jpeg")
+            return
+
+        # Путь вида /bot<token>/<method>
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            self.reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        self.reply(200, {"ok": True, "result": fake.call(parts[1], params)})
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), BotApiHandler)
+    print(f"Fake Telegram API слушает http://127.0.0.1:{port}")
+    server.serve_forever()
+
+# Запуск сервера в фоновом потоке того же процесса
+def start(port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), BotApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ===================================================
+# =============== Отправка обновлений ===============
+# ===================================================
+
+update_ids = itertools.count(1)
+
+def make_user_message(user_id, chat_id=None, **extra):
+    message = {
+        "message_id": next(fake.message_ids),
+        "from": {"id": user_id, "is_bot": False, "first_name": "Rider"},
+        "chat": {"id": chat_id or user_id, "type": "private" if chat_id is None else "supergroup"},
+        "date": int(time.time()),
+    }
+    message.update(extra)
+    return message
+
+def make_text_update(user_id, text, chat_id=None, reply_to=None):
+    extra = {"text": text}
+    if reply_to is not None:
+        extra["reply_to_message"] = reply_to
+    return {"update_id": next(update_ids), "message": make_user_message(user_id, chat_id, **extra)}
+
+def make_photo_update(user_id, file_id):
+    photo = [
+        {"file_id": f"{file_id}_s", "file_unique_id": f"{file_id}_s", "width": 320, "height": 240},
+        {"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960},
+    ]
+    return {"update_id": next(update_ids), "message": make_user_message(user_id, photo=photo)}
+
+# Нажатие инлайн-кнопки под сообщением бота
+def make_callback_update(user_id, message, data):
+    return {
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)),
+            "from": {"id": user_id, "is_bot": False, "first_name": "Admin"},
+            "message": message,
+            "chat_instance": "benchmark",
+            "data": data,
+        },
+    }
+
+def push_update(webhook_url, secret, update):
+    request = urllib.request.Request(
+        webhook_url,
+        data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve")
+    serve_parser.add_argument("--port", type=int, default=8081)
+
+    send_parser = commands.add_parser("send")
+    send_parser.add_argument("--webhook", default="http://localhost:5000/webhook")
+    send_parser.add_argument("--secret", default="")
+    send_parser.add_argument("--user-id", type=int, default=1)
+    send_parser.add_argument("--text", required=True)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args.port)
+    else:
+        print(push_update(args.webhook, args.secret, make_text_update(args.user_id, args.text)))
@@ -0,0 +1,110 @@
+# ================================================
+# =============== ВАЛИДАЦИЯ ЗАЯВКИ ===============
+# ================================================
+
+# Проверка полей заявки на возврат. Каждое поле разбирается один раз заранее
+# скомпилированным шаблоном, результат — Validation(value, error):
+#   value — нормализованное значение для сохранения (None при ошибке)
+#   error — причина отказа: 'format', 'range', 'digits' или 'length' (None, если поле верно)
+#
+# Повторная проверка сохранённых заявок:
+#   python report_validators.py --mongo mongodb://localhost:27017/ --database AkkuBattBotSup
+
+import argparse
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+RENTAL_TIME_PATTERN = re.compile(r"(\d{1,2})\.(\d{1,2}) (\d{1,2}):(\d{1,2})")
+PHONE_PATTERN = re.compile(r"(?:\+7|7|8)([0-9]{10})")
+DIGITS_PATTERN = re.compile(r"[0-9]+")
+
+RENTAL_TIME_MAX_AGE = timedelta(days=30)
+
+
+class Validation(namedtuple('Validation', ['value', 'error'])):
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def valid(value):
+    return Validation(value, None)
+
+def invalid(error):
+    return Validation(None, error)
+
+# ==============================================
+# =============== Проверки полей ===============
+# ==============================================
+
+# Время начала аренды ДД.ММ ЧЧ:ММ в текущем году, не старше 30 дней относительно now
+def validate_rental_time(text, now=None):
+    match = RENTAL_TIME_PATTERN.fullmatch(text.strip())
+    if not match:
+        return invalid('format')
+
+    now = now or datetime.now()
+    day, month, hour, minute = map(int, match.groups())
+    try:
+        rental_datetime = datetime(now.year, month, day, hour, minute)
+    except ValueError:
+        return invalid('format')
+
+    if rental_datetime < now - RENTAL_TIME_MAX_AGE:
+        return invalid('range')
+    return valid(rental_datetime.strftime("%d.%m %H:%M"))
+
+# Номер из length цифр: номер самоката, последние цифры карты. Пробелы не обрезаются, как и раньше
+def validate_digits(text, length=4):
+    if not DIGITS_PATTERN.fullmatch(text):
+        return invalid('digits')
+    if len(text) != length:
+        return invalid('length')
+    return valid(text)
+
+# Российский номер в формате +7XXXXXXXXXX, 7XXXXXXXXXX или 8XXXXXXXXXX, приводится к +7XXXXXXXXXX
+def validate_phone_number(text):
+    match = PHONE_PATTERN.fullmatch(text.strip())
+    if not match:
+        return invalid('format')
+    return valid('+7' + match.group(1))
+
+
+# Проверки полей сохранённой заявки; время аренды сверяется с датой создания заявки
+REPORT_VALIDATORS = {
+    'rental_time': lambda report: validate_rental_time(report.get('rental_time') or '', report.get('created_at')),
+    'scooter_number': lambda report: validate_digits(report.get('scooter_number') or ''),
+    'phone_number': lambda report: validate_phone_number(report.get('phone_number') or ''),
+    'card_number': lambda report: validate_digits(report.get('card_number') or ''),
+}
+
+# Возвращает {поле: причина} для неверных полей заявки
+def validate_report(report):
+    errors = {}
+    for field, validate in REPORT_VALIDATORS.items():
+        result = validate(report)
+        if not result.ok:
+            errors[field] = result.error
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Повторная проверка сохранённых заявок")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="AkkuBattBotSup")
+    args = parser.parse_args()
+
+    from pymongo import MongoClient
+
+    fields = {"_id": 0, "id": 1, "created_at": 1, **{field: 1 for field in REPORT_VALIDATORS}}
+    checked = failed = 0
+    for report in MongoClient(args.mongo)[args.database].reports.find({}, fields).batch_size(500):
+        checked += 1
+        errors = validate_report(report)
+        if errors:
+            failed += 1
+            print(f"Отчет #{report.get('id')}: {errors}")
+    print(f"Проверено заявок: {checked}, с ошибками: {failed}")